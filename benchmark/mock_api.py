@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+class MockRia:
+    # Local stand-in for developers.ria.com serving recorded responses
+    fixtures_location = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+    catalogs = {
+        '/auto/categories/1/marks': 'marks',
+        '/auto/categories/1/bodystyles': 'bodystyles',
+        '/auto/categories/1/gearboxes': 'gearboxes',
+        '/auto/categories/1/options': 'options',
+        '/auto/type': 'type',
+        '/auto/colors': 'colors',
+        '/auto/countries': 'countries'
+    }
+    first_id = 24000000
+    first_year = 2000
+    years = 20
+
+    def __init__(self, count=1000, latency=0.0, jitter=0.0, error_rate=0.0, limit_rate=0.0, retry_after=1, seed=0):
+        self.count = count
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.limit_rate = limit_rate
+        self.retry_after = retry_after
+        self.fixtures = {}
+        for name in os.listdir(self.fixtures_location):
+            with open(os.path.join(self.fixtures_location, name), 'r', encoding='utf8') as fixture:
+                self.fixtures[os.path.splitext(name)[0]] = json.load(fixture)
+        self.bodies = [body['value'] for body in self.fixtures['bodystyles']]
+        self.fuels = [fuel['value'] for fuel in self.fixtures['type']]
+        # Search attributes of every car, spread evenly so that partitioned searches have something to split
+        self.cars = [(self.first_id + i, self.first_year + i * 7 % self.years, self.bodies[i % len(self.bodies)],
+                      self.fuels[i // len(self.bodies) % len(self.fuels)]) for i in range(count)]
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        if self.jitter:
+            with self.random_lock:
+                return self.latency + self.random.uniform(0, self.jitter)
+        return self.latency
+
+    def respond(self, path, query):
+        # Status code, JSON body and headers of a response
+        with self.random_lock:
+            self.requests += 1
+        time.sleep(self.delay())
+        if self.chance(self.limit_rate):
+            return 429, {'error': {'code': 'OVER_RATE_LIMIT', 'message': 'Too many requests'}}, {
+                'Retry-After': str(self.retry_after)}
+        if self.chance(self.error_rate):
+            return 500, {'error': {'code': 'SERVER_ERROR', 'message': 'Mock server error'}}, {}
+        path = path.rstrip('/')
+        if path in self.catalogs:
+            return 200, self.fixtures[self.catalogs[path]], {}
+        if path.startswith('/auto/categories/1/marks/') and path.endswith('/models'):
+            return 200, self.fixtures['models'], {}
+        if path == '/auto/average_price':
+            return 200, self.fixtures['average_price'], {}
+        if path == '/auto/search':
+            return 200, self.search(query), {}
+        if path == '/auto/info':
+            return self.info(query)
+        return 404, {'error': {'code': 'NOT_FOUND', 'message': 'Unknown method %s' % path}}, {}
+
+    def search(self, query):
+        low, high = int(query.get('s_yers', 0)), int(query.get('po_yers', 9999))
+        body, fuel = query.get('bodystyle'), query.get('type')
+        ids = [str(auto_id) for (auto_id, year, car_body, car_fuel) in self.cars
+               if low <= year <= high and (body is None or int(body) == car_body)
+               and (fuel is None or int(fuel) == car_fuel)]
+        page, countpage = int(query.get('page', 0)), int(query.get('countpage', 10))
+        result = copy.deepcopy(self.fixtures['search'])
+        search_result = result['result']['search_result']
+        search_result['ids'] = ids[page * countpage:(page + 1) * countpage]
+        search_result['count'] = len(ids)
+        result['result']['search_result_common']['count'] = len(ids)
+        result['additional_params']['page'] = page
+        return result
+
+    def info(self, query):
+        index = int(query.get('auto_id', 0)) - self.first_id
+        if not 0 <= index < self.count:
+            return 404, {'error': {'code': 'NOT_FOUND', 'message': 'Advertisement not found'}}, {}
+        auto_id, year, body, fuel = self.cars[index]
+        car = copy.deepcopy(self.fixtures['info'])
+        price = 3000 + index * 37 % 9000
+        car['USD'], car['UAH'], car['EUR'] = price, price * 25, round(price * 0.9)
+        car['title'] = 'Ford Focus %s' % year
+        car['linkToView'] = '/auto_ford_focus_%s.html' % auto_id
+        car['autoData'].update({'autoId': auto_id, 'year': year, 'bodyId': body, 'fuelId': fuel,
+                                'raceInt': 50 + index * 13 % 250})
+        return 200, car, {}
+
+    def start(self, port=0):
+        # Serve from a background thread, returns the base URL
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def handler(self):
+        mock = self
+
+        class MockRiaHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, do not delay the body of kept-alive responses
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+                code, data, headers = mock.respond(url.path, query)
+                body = json.dumps(data, ensure_ascii=False).encode('utf8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for (name, value) in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return MockRiaHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve recorded RIA API responses locally')
+    parser.add_argument('-p', '--port', type=int, default=8765, help='Port to listen on. Default is 8765.')
+    parser.add_argument('-n', '--count', type=int, default=1000, help='Number of cars found. Default is 1000.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Response delay in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra delay up to this many seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with 500.')
+    parser.add_argument('--limit-rate', type=float, default=0.0, help='Share of requests rejected with 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of 429 responses in seconds.')
+    opts = parser.parse_args()
+
+    mock = MockRia(opts.count, opts.latency, opts.jitter, opts.error_rate, opts.limit_rate, opts.retry_after)
+    print('Serving %s cars on %s, set "api_url" in config/ria.ini to use it' % (opts.count, mock.start(opts.port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import argparse
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tabulate
+import tempfile
+import time
+from mock_api import MockRia
+
+
+class Benchmark:
+    run_py = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run.py')
+    search = ['-m', 'Ford', '-M', 'Focus']
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def config(self, workdir, url):
+        # Default config and API key prompt of run.py itself, then pointed to the mock server without
+        # request limit and details cache
+        subprocess.run([sys.executable, self.run_py], cwd=workdir, input=b'benchmark\n', stdout=subprocess.DEVNULL,
+                       check=True)
+        path = os.path.join(workdir, 'config', 'ria.ini')
+        parser = configparser.ConfigParser()
+        parser.read(path)
+        parser['RIA_CONFIG'].update({
+            'api_url': url,
+            'requests_per_hour': '1000000000',
+            'details_cache_expiry_time': '0',
+            'output_format': self.opts.output
+        })
+        if self.opts.workers:
+            parser['RIA_CONFIG']['workers'] = str(self.opts.workers)
+        with open(path, 'w') as config:
+            parser.write(config)
+
+    def run(self, size):
+        mock = MockRia(size, self.opts.latency, self.opts.jitter, self.opts.error_rate, self.opts.limit_rate,
+                       self.opts.retry_after)
+        url = mock.start()
+        workdir = tempfile.mkdtemp(prefix='ria_benchmark_')
+        try:
+            self.config(workdir, url)
+            metrics_path = os.path.join(workdir, 'metrics.json')
+            with open(os.path.join(workdir, 'run.log'), 'w') as log:
+                start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, self.run_py] + self.search +
+                                           ['-qm', '--metrics', metrics_path], cwd=workdir, stdout=log, stderr=log)
+                # Resource usage of this very run, peak memory is in kilobytes on Linux
+                _, status, usage = os.wait4(process.pid, 0)
+                seconds = time.perf_counter() - start
+            if os.waitstatus_to_exitcode(status) != 0 or not os.path.isfile(metrics_path):
+                with open(os.path.join(workdir, 'run.log'), 'r') as log:
+                    sys.exit('Benchmark run of %s cars failed:\n%s' % (size, log.read()[-2000:]))
+            with open(metrics_path, 'r') as metrics:
+                metrics = json.load(metrics)
+        finally:
+            mock.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+        info = metrics['requests'].get('info', {})
+        return {
+            'cars': size,
+            'seconds': round(seconds, 3),
+            'cars_per_second': round(size / seconds, 1),
+            'peak_memory_mb': round(usage.ru_maxrss / 1024.0, 1),
+            'requests': mock.requests,
+            'stages': metrics['stages'],
+            'info': info
+        }
+
+    @staticmethod
+    def report(results):
+        header = ['cars', 'seconds', 'cars/s', 'peak MB', 'requests', 'catalog', 'pagination', 'details',
+                  'extraction', 'output', 'info p50 ms', 'info p95 ms', 'info p99 ms']
+        rows = []
+        for result in results:
+            stages = result['stages']
+            rows.append([result['cars'], result['seconds'], result['cars_per_second'], result['peak_memory_mb'],
+                         result['requests']] +
+                        ['%.3f' % stages.get(stage, 0) for stage in header[5:10]] +
+                        ['%.0f' % result['info'].get(p, float('nan')) for p in ('p50_ms', 'p95_ms', 'p99_ms')])
+        return tabulate.tabulate(rows, header)
+
+    def compare(self, results):
+        # Runs slower than the saved ones by more than the tolerance are regressions
+        with open(self.opts.compare, 'r') as saved:
+            baseline = {result['cars']: result for result in json.load(saved)}
+        regressions = []
+        for result in results:
+            previous = baseline.get(result['cars'])
+            if not previous or not previous['cars_per_second']:
+                continue
+            change = result['cars_per_second'] / previous['cars_per_second'] - 1
+            print('%s cars: %.1f cars/s, %+.1f%% compared to %.1f cars/s' % (
+                result['cars'], result['cars_per_second'], change * 100, previous['cars_per_second']))
+            if change < -self.opts.tolerance:
+                regressions.append(str(result['cars']))
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark searches against a local mock RIA API')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Numbers of cars found by benchmark searches. Default is 100 1000 10000.')
+    parser.add_argument('-w', '--workers', type=int, help='Number of concurrent detail downloads.')
+    parser.add_argument('-o', '--output', default='csv', choices=['txt', 'csv', 'parquet', 'sqlite'],
+                        help='Search output. Default is "csv".')
+    parser.add_argument('--latency', type=float, default=0.02, help='Mock response delay, default is 0.02 s.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra mock delay up to this many seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of mock requests failing with 500.')
+    parser.add_argument('--limit-rate', type=float, default=0.0, help='Share of mock requests rejected with 429.')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After of 429 responses, default is 0 s.')
+    parser.add_argument('--save', metavar='FILE', help='Save results into FILE as JSON.')
+    parser.add_argument('--compare', metavar='FILE', help='Compare throughput with results saved by --save.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Throughput drop treated as a regression by --compare. Default is 0.2.')
+    opts = parser.parse_args()
+
+    benchmark = Benchmark(opts)
+    results = []
+    for size in opts.sizes:
+        print('Searching %s cars...' % size)
+        results.append(benchmark.run(size))
+    print(benchmark.report(results))
+
+    if opts.save:
+        with open(opts.save, 'w') as saved:
+            json.dump(results, saved, indent=2)
+    if opts.compare:
+        regressions = benchmark.compare(results)
+        if regressions:
+            sys.exit('Throughput regression for %s cars' % ', '.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
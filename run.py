@@ -1,39 +1,39 @@
 #!/usr/bin/env python3
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import logging.handlers
-from src.log import RiaLogger
+from src.log import LazyJson, RiaLogger
+import shlex
 import sys
+import tabulate
 import time
-from src.search import Advertisement
-from src.search import VehicleDetails
-from src.output import Output
-from tqdm import tqdm
+from src.search import Advertisement, VehicleDetails
+from src.config import Config
+from src.delta import DeltaSearch
+from src.details import DetailCache
+from src.fetch import DetailFetcher, DetailRegistry
+from src.journal import RunJournal
+from src.metrics import RunMetrics
+from src.output import BatchOutput, Output
+from src.stats import ResultStats
 
 
 def main():
     logger = logging.getLogger("ria.run")
-    fh = logging.FileHandler("ria.log")
-    formatter = logging.Formatter(RiaLogger.log_format_info)
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
-
-    # Initialize search
-    search = Advertisement()
-    local_output = Output()
 
     ria_description = 'Get car advertisements from https://auto.ria.com'
     example = 'EXAMPLE ./run.py -m Ford -M Focus'
 
     parser = argparse.ArgumentParser(description=ria_description, epilog=example)
-    parser.add_argument('-get', choices=search.aux)
+    parser.add_argument('-get', choices=Advertisement.aux)
     parser.add_argument('-k', '--key', type=str, dest='api_key', metavar='API_KEY',
                         help='Update RIA API key.')
-    parser.add_argument('-m', '--make', type=str, dest='marka_id', metavar='MAKE', choices=search.make_names,
+    parser.add_argument('-m', '--make', type=str, dest='marka_id', metavar='MAKE',
                         help='Car make.')
     parser.add_argument('-M', '--model', type=str, dest='model_id', metavar='MODEL',
                         help='Car model.')
-    parser.add_argument('-b', '--body', type=str, dest='bodystyle', metavar='BODY', choices=search.bodies,
+    parser.add_argument('-b', '--body', type=str, dest='bodystyle', metavar='BODY',
                         help='Body style.')
     parser.add_argument('-y', '--year-start', type=int, dest='s_yers', metavar='YEAR',
                         help='Car production year lower limit.')
@@ -43,38 +43,69 @@ def main():
                         help='Engine capacity lower limit.')
     parser.add_argument('-L', '--capacity-to', type=float, dest='engineVolumeTo', metavar='CAPACITY',
                         help='Engine capacity upper limit.')
-    parser.add_argument('-g', '--gearbox', type=str, metavar='GEARBOX', choices=search.gearboxes,
+    parser.add_argument('-g', '--gearbox', type=str, metavar='GEARBOX',
                         help='Gearbox type.')
     parser.add_argument('-f', '--fuel', type=str, dest='type', metavar='FUEL',
-                        choices=search.fuel_type.keys(),
                         help='Fuel type.')
-    parser.add_argument('-c', '--color', type=str, metavar='COLOR', choices=search.colors.keys(),
+    parser.add_argument('-c', '--color', type=str, metavar='COLOR',
                         help='Car color.')
-    parser.add_argument('-C', '--country', type=str, dest='brandOrigin', metavar='COUNTRY', choices=search.countries,
+    parser.add_argument('-C', '--country', type=str, dest='brandOrigin', metavar='COUNTRY',
                         help='Brand origin.')
-    parser.add_argument('-O', '--options', type=str, dest='auto_options', metavar='OPTIONS', choices=search.options,
+    parser.add_argument('-O', '--options', type=str, dest='auto_options', metavar='OPTIONS',
                         help='Car options.')
-    parser.add_argument('-p', '--period', type=str, dest='top', metavar='PERIOD', choices=search.period.keys(),
+    parser.add_argument('-p', '--period', type=str, dest='top', metavar='PERIOD', choices=Advertisement.period.keys(),
                         help='Period in hours. Also options like "week", "month", "quarter", "today" possible.')
-    parser.add_argument('-s', '--sort', type=str, dest='order_by', metavar='SORT', choices=search.sort.keys(),
+    parser.add_argument('-s', '--sort', type=str, dest='order_by', metavar='SORT', choices=Advertisement.sort.keys(),
                         help='Sort search results, default is "price_up".')
     parser.add_argument('-S', '--status', type=str, dest='saledParam', metavar='STATUS',
-                        choices=search.status.keys(),
+                        choices=Advertisement.status.keys(),
                         help='Sale status: "all", "sold", "sale". Default is "sale".')
     parser.add_argument('-d', '--damage', type=str, dest='damage', metavar='DAMAGE',
-                        choices=search.damage.keys(),
+                        choices=Advertisement.damage.keys(),
                         help='Has damage: "yes", "no", "all". Default is "no".')
-    parser.add_argument('-o', '--output', type=str, dest='output', metavar='OUTPUT', choices=['txt', 'csv'],
-                        help='Search output. Default is "csv".')
+    parser.add_argument('-o', '--output', type=str, dest='output', metavar='OUTPUT',
+                        choices=['txt', 'csv', 'ndjson', 'parquet', 'sqlite'],
+                        help='Search output, "ndjson" is printed to stdout. Default is "csv".')
+    parser.add_argument('-w', '--workers', type=int, dest='workers', metavar='WORKERS',
+                        help='Number of concurrent detail downloads. Default is "workers" from config.')
+    parser.add_argument('-D', '--delta', dest='delta', action='store_true',
+                        help='Download only cars not found by the previous search with the same criteria, '
+                             'save new and removed cars.')
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true',
+                        help='Continue interrupted search with the same criteria.')
+    parser.add_argument('--stats', dest='stats', action='store_true',
+                        help='Print price and mileage statistics per production year after search.')
+    parser.add_argument('--local', dest='local', action='store_true',
+                        help='Compute "-get average-price" from cars downloaded by previous searches, '
+                             'RIA is asked only if there are too few recent ones.')
+    parser.add_argument('--profile', dest='profile', nargs='?', const='ria.prof', metavar='FILE',
+                        help='Save cProfile stats of the run into FILE (default "ria.prof") and their summary '
+                             'into FILE.txt.')
+    parser.add_argument('--metrics', dest='metrics', metavar='FILE',
+                        help='Save run metrics summary into FILE as JSON.')
+    parser.add_argument('--batch', dest='batch', metavar='FILE',
+                        help='Run searches of FILE, one per line with the same options, in one process.')
+    parser.add_argument('--combined', dest='combined', action='store_true',
+                        help='Write cars found by all "--batch" searches into one output.')
     parser.add_argument('-qm', '--quiet-mode', dest='quiet', help="Quiet mode", action="store_true")
     parser.add_argument("-v", "--verbose", help="Increase output verbosity.", action="store_true")
 
+    # Help and API key update need neither the key nor the session and caches
     opts = parser.parse_args()
-
+    RiaLogger.start()
     if opts.api_key:
-        search.config.store_api_key('config/key.pkl', opts.api_key)
+        Config.shared().store_api_key('config/key.pkl', opts.api_key)
         exit(0)
 
+    metrics = RunMetrics.shared()
+    if opts.profile:
+        metrics.start_profile(opts.profile)
+
+    # Initialize search
+    search = Advertisement()
+    RiaLogger.configure(search.config)
+    local_output = Output()
+
     if opts.verbose:
         logger.setLevel(logging.DEBUG)
     else:
@@ -86,6 +117,50 @@ def main():
     # Set 'requests' lib WARN level logger
     logging.getLogger("requests").setLevel(logging.WARN)
 
+    if opts.output:
+        local_output.format = opts.output
+    if local_output.format == 'ndjson':
+        RiaLogger.messages = sys.stderr
+
+    if opts.combined and not opts.batch:
+        parser.error('argument --combined: needs argument --batch')
+    if opts.batch:
+        run_batch(search, parser, opts, local_output)
+    else:
+        run_query(search, parser, opts, local_output)
+
+    search.end_time = time.time()
+    search.runtime = search.end_time - search.start_time
+    if search.warn:
+        logger.warning("Finished search in %.2f seconds with warnings" % search.runtime)
+    else:
+        logger.debug("Finished search in %.2f seconds" % search.runtime)
+    logger.info('%s of %s requests left within the hourly limit' % (search.limiter.remaining(),
+                                                                     search.limiter.budget))
+    # Summary goes to the log only when cars are printed to stdout
+    RiaLogger.log('Run metrics:\n%s' % metrics.report(), 'info', suppress_stdout=local_output.format == 'ndjson')
+    if opts.metrics:
+        metrics.save(opts.metrics)
+
+
+def run_query(search, parser, opts, local_output):
+    logger = logging.getLogger("ria.run")
+    metrics = search.metrics
+
+    # Load only catalogs needed by the given options
+    catalogs = [spec for (dest, spec) in search.catalog_options.items() if getattr(opts, dest)]
+    if opts.get in (None, 'reprocess') and 'autoData_bodyId' in search.config.get_fields_to_extract():
+        catalogs.append('styles')
+    with metrics.stage('catalog'):
+        search.load_catalogs(catalogs)
+    for (dest, spec) in search.catalog_options.items():
+        value = getattr(opts, dest)
+        if value:
+            choices = search.extract_key_names(search.catalog(spec))
+            if value not in choices:
+                parser.error("invalid choice: '%s' (choose from %s)" % (value,
+                                                                       ', '.join("'%s'" % c for c in choices)))
+
     if opts.marka_id:
         search.make_name = opts.marka_id
         search.make_id = opts.marka_id = search.get_car_make_id(search.make_name)
@@ -98,7 +173,8 @@ def main():
         if not opts.marka_id:
             RiaLogger.log('Need a car make first (e.g. --make Ford)', 'error')
             sys.exit(2)
-        search.models = search.all_models()
+        with metrics.stage('catalog'):
+            search.models = search.all_models()
         search.model_names = search.extract_key_names(search.models)
         if search.model_is_valid(opts.model_id):
             search.model_name = opts.model_id
@@ -109,8 +185,39 @@ def main():
         if opts.get == 'average-price':
             ap_opts = ['marka_id', 'model_id', 'gearbox', 's_yers', 'type']
             search.set_avg_price_criteria({k: v for (k, v) in vars(opts).items() if v and k in ap_opts})
-            search.average_price()
+            search.average_price(opts.local)
             logger.info('Printed out Ria average prices to stdout')
+        elif opts.get == 'reprocess':
+            # Archived car details extracted again with current fields and written to a new output, no downloads
+            if opts.output:
+                local_output.format = opts.output
+            local_output.check_format()
+            filters = {}
+            if search.make_id:
+                filters['markId'] = search.make_id
+            if search.model_id:
+                filters['modelId'] = search.model_id
+            bodies = search.bodies if 'styles' in catalogs else {}
+            plan = VehicleDetails.compile_plan(search.config, bodies)
+            with metrics.stage('extraction'):
+                rows = search.archive.reprocess((plan.fields, search.config.convert_field, bodies, search.ria_url),
+                                                search.config.read_config('RIA_CONFIG', 'extraction'), filters,
+                                                opts.workers)
+            if not rows:
+                RiaLogger.log('No archived car details to reprocess', 'info')
+                sys.exit(0)
+            with metrics.stage('output'):
+                local_output.open(plan.columns, search.make_name or 'Archive', search.model_name or '', 'reprocessed')
+                for row in rows:
+                    local_output.writerow(row)
+                local_output.close(False)
+            logger.info('Reprocessed %s archived cars' % len(rows))
+        elif opts.get == 'warm-cache':
+            refreshed = search.warm_cache()
+            RiaLogger.log('Refreshed %s catalogs' % refreshed, 'info')
+        elif opts.get == 'budget':
+            RiaLogger.log('%s of %s requests left within the hourly limit' % (search.limiter.remaining(),
+                                                                              search.limiter.budget), 'info')
         sys.exit(0)
 
     if opts.bodystyle:
@@ -137,6 +244,7 @@ def main():
         opts.damage = search.damage['no']
     if opts.output:
         local_output.format = opts.output
+    local_output.check_format()
     if opts.auto_options:
         opts.auto_options = search.options[opts.auto_options]
     if opts.brandOrigin:
@@ -145,53 +253,231 @@ def main():
     # Convert options into query parameters
     search.criteria = {k: v for (k, v) in vars(opts).items() if v and k not in search.opts_to_remove}
 
-    logger.debug("Searching by following criteria %s" % search.dump_json(
-        search.criteria, 1, (',', '='), data_type=dict))
+    logger.debug("Searching by following criteria %s", LazyJson(search.criteria, 1, (',', '='), data_type='dict'))
 
-    # Start searching ads
-    ads_ids = search.vehicle_ads()
+    # Interrupted searches are continued from the journal, only "csv" output can be resumed
+    journal = None
+    if local_output.resumable:
+        journal = RunJournal(search.config, search.criteria_key(search.criteria))
+    state = None
+    if opts.resume:
+        state = journal.load() if journal else None
+        if not state:
+            RiaLogger.log('No interrupted "csv" search to resume by given criteria', 'error')
+            sys.exit(2)
+        logger.info('Resuming search from car %s of %s' % (state['committed'], len(state['ids'])))
+
+    if opts.delta:
+        delta = DeltaSearch(search.config, search.criteria_key(search.criteria))
+
+    if state:
+        ads_ids = state['ids']
+        local_output.time = state['time']
+        if opts.delta:
+            found_ids = state['found']
+            delta.removed = state['removed']
+    else:
+        # Start searching ads
+        ads_ids = search.vehicle_ads()
+
+        if opts.delta:
+            found_ids = ads_ids
+            ads_ids = delta.compare(found_ids)
+            if not ads_ids and not delta.removed:
+                RiaLogger.log('No new or removed cars since previous search', 'info')
+                delta.save(found_ids)
+                exit(0)
+
+    start = state['committed'] if state else 0
 
     # Token connection limit warning
-    if len(ads_ids) >= 500:
-        print('Might go over the token connection limit,')
+    wait = search.limiter.estimate(len(ads_ids) - start)
+    if wait:
+        RiaLogger.echo('%s cars to download, %s requests left within the hourly limit,' % (
+            len(ads_ids) - start, search.limiter.remaining()))
+        RiaLogger.echo('downloads will be slowed down to fit the limit, about %.0f minutes' % (wait / 60))
         ask = 'continue? (y/n)'
         if not search.continue_search(ask):
             logger.info('Search is cancelled by user')
             exit(0)
 
-    logger.debug('Extracting following fields: %s' % search.dump_json(search.config.convert_field.values(),
-                                                                      data_type='list'))
-    advertisements = [VehicleDetails(adv, search.bodies) for adv in ads_ids]
-    for a in tqdm(advertisements, desc='Downloading cars info', unit='cars'):
-        a.get()
-        if a.failed:
-            break
+    logger.debug('Extracting following fields: %s', LazyJson(search.config.convert_field.values(), data_type='list'))
+    fetcher = DetailFetcher(search.bodies if 'styles' in catalogs else {}, opts.workers)
+    header = fetcher.plan.columns
+    if opts.delta:
+        header = ['status'] + header
+    kind = 'delta' if opts.delta else None
+    if state and state.get('header') != list(header):
+        RiaLogger.log('Interrupted search was written with other columns, check -D option and [OUTPUT] fields '
+                      'or run it again without --resume', 'error')
+        sys.exit(2)
+    if state:
+        local_output.open(header, search.make_name, search.model_name, kind, state['count'], state['offset'])
+    else:
+        local_output.open(header, search.make_name, search.model_name, kind)
+    if journal:
+        if not state:
+            journal.start(search.criteria, ads_ids, local_output.time, local_output.part_path, header,
+                          (found_ids, delta.removed) if opts.delta else None)
+        local_output.on_flush = journal.commit
 
-    ads_src_data = [a.csv for a in advertisements if a.code]
-    search_runtime_debug = [{"id": a.id, "search_time": a.run_time} for a in advertisements]
+    # Write cars to output as soon as they are downloaded, stop at the first car failed to download
+    downloaded = start
+    search_runtime_debug = []
+    stats = ResultStats()
+    try:
+        for a in fetcher.iter_fetch(ads_ids[start:]):
+            search_runtime_debug.append({"id": a.id, "search_time": a.run_time})
+            if not a.code:
+                break
+            downloaded += 1
+            if journal:
+                journal.advance()
+            if opts.stats:
+                stats.add(a.csv)
+            with metrics.stage('output'):
+                local_output.writerow(delta.row('added', a.csv) if opts.delta else a.csv)
+    except KeyboardInterrupt:
+        if journal:
+            local_output.flush()
+            RiaLogger.log('Search interrupted, run it again with --resume to continue', 'warn')
+        else:
+            # Only "csv" output can be resumed, others keep cars downloaded so far in a complete file
+            local_output.close(True)
+            RiaLogger.log('Search interrupted', 'warn')
+        sys.exit(1)
 
-    if len(ads_src_data) == 0:
+    if downloaded == 0 and len(ads_ids) != 0:
+        if journal:
+            local_output.flush()
+        else:
+            local_output.discard()
         exit('Search error')
-    elif len(ads_src_data) != len(ads_ids):
+    elif downloaded != len(ads_ids):
         logger.warning('Inaccurate search results due to errors, check log for more details')
         search.warn = True
 
-    logger.info("Downloaded details for %s cars" % len(ads_src_data))
-    logger.debug('Converted Ria results into source CSV values: %s' % search.dump_json(ads_src_data))
+    if search.warn and journal:
+        # Keep unfinished file and journal to resume later, save what is downloaded so far
+        local_output.flush()
+        local_output.save_copy(search.warn)
+        RiaLogger.log('Run the search again with --resume to download remaining cars', 'warn')
+    else:
+        with metrics.stage('output'):
+            if opts.delta:
+                # Remember found ids only if all new cars were downloaded, otherwise retry them next time
+                if not search.warn:
+                    delta.save(found_ids)
+                for row in delta.removed_rows(fetcher.plan, DetailCache.shared(search.config)):
+                    local_output.writerow(row)
 
-    # Set file name
-    local_output.set_path(search.make_name, search.model_name, len(ads_src_data), search.warn)
+            # Rename output file to its final name
+            local_output.close(search.warn)
+        if journal:
+            journal.finish()
 
-    # Write to file
-    local_output.write(ads_src_data)
+    logger.info("Downloaded details for %s cars" % downloaded)
 
-    search.end_time = time.time()
-    search.runtime = search.end_time - search.start_time
-    if search.warn:
-        logger.warning("Finished search in %.2f seconds with warnings" % search.runtime)
-    else:
-        logger.debug("Finished search in %.2f seconds" % search.runtime)
-    search.logger.debug("Detailed run times: %s" % search.dump_json(search_runtime_debug))
+    if opts.stats:
+        RiaLogger.log(stats.report(), 'info')
+
+    search.logger.debug("Detailed run times: %s", LazyJson(search_runtime_debug))
+    return downloaded
+
+
+def run_batch(search, parser, opts, local_output):
+    # Searches of a file run by one process, sharing session, catalogs and caches, several at a time
+    logger = logging.getLogger("ria.run")
+    if opts.get:
+        parser.error('argument --batch: not allowed with argument -get')
+    if opts.output:
+        local_output.format = opts.output
+    local_output.check_format()
+    if opts.combined and local_output.format == 'sqlite':
+        parser.error('argument --combined: not allowed with "sqlite" output, it keeps cars of all searches anyway')
+    queries = []
+    try:
+        with open(opts.batch, 'r', encoding='utf8') as batch:
+            lines = batch.read().splitlines()
+    except OSError as e:
+        parser.error("argument --batch: can't open '%s': %s" % (opts.batch, e))
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        # Options given on the command line apply to every search of the file
+        query_opts = parser.parse_args(shlex.split(line), argparse.Namespace(**dict(vars(opts), batch=None)))
+        if query_opts.batch or query_opts.get or query_opts.api_key:
+            parser.error('line %s of %s: -get, -k and --batch are not allowed in batch searches' % (number,
+                                                                                                    opts.batch))
+        if opts.combined and (query_opts.resume or query_opts.output != opts.output):
+            parser.error('line %s of %s: --resume and -o are not allowed in combined batch searches' % (
+                number, opts.batch))
+        queries.append((number, line, query_opts))
+
+    # Catalogs are loaded once for all searches
+    catalogs = [spec for (number, line, query_opts) in queries
+                for (dest, spec) in search.catalog_options.items() if getattr(query_opts, dest)]
+    if 'autoData_bodyId' in search.config.get_fields_to_extract():
+        catalogs.append('styles')
+    with search.metrics.stage('catalog'):
+        search.load_catalogs(catalogs)
+
+    header = None
+    if opts.combined:
+        bodies = search.bodies if 'styles' in catalogs else {}
+        header = VehicleDetails.compile_plan(search.config, bodies).columns
+        if any(query_opts.delta for (number, line, query_opts) in queries):
+            header = ['status'] + header
+        header = ['query'] + header
+        local_output.open(header, 'Batch', '', 'combined')
+
+    # Cars found by several searches are downloaded once
+    DetailRegistry.shared().retain = True
+    workers = int(search.config.read_config('RIA_CONFIG', 'batch_workers'))
+    logger.info('Running %s searches of %s, %s at a time' % (len(queries), opts.batch, workers))
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for (number, line, query_opts) in queries:
+            if opts.combined:
+                output = BatchOutput(local_output, header, line)
+            else:
+                output = Output()
+                output.label = 'q%s' % number
+            futures.append(executor.submit(run_batch_query, search, parser, query_opts, output))
+        try:
+            for ((number, line, query_opts), future) in zip(queries, futures):
+                results.append([number, line] + list(future.result()))
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            RiaLogger.log('Batch interrupted, waiting for running searches to finish', 'warn')
+            sys.exit(1)
+
+    search.warn = any(status in ('warnings', 'failed') for (number, line, downloaded, status) in results)
+    if opts.combined:
+        local_output.close(search.warn)
+    RiaLogger.log('Batch searches:\n%s' % tabulate.tabulate(results, ['line', 'search', 'cars', 'status']), 'info',
+                  suppress_stdout=local_output.format == 'ndjson')
+
+
+def run_batch_query(search, parser, opts, output):
+    # Returns number of downloaded cars and search status
+    query = Advertisement()
+    query.catalogs = search.catalogs
+    # Nobody answers prompts of concurrent searches
+    query.quiet = True
+    try:
+        downloaded = run_query(query, parser, opts, output)
+    except SystemExit as e:
+        # Searches stop early without an error e.g. when there are no new cars, invalid options exit with 2
+        if e.code in (None, 0):
+            return 0, 'stopped'
+        return 0, 'failed'
+    except Exception:
+        query.logger.exception('Batch search failed')
+        return 0, 'failed'
+    return downloaded, 'warnings' if query.warn else 'ok'
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from flatten_json import flatten
+import glob
+import gzip
+import json
+import logging
+import os
+from src.extract import ExtractionPlan
+import threading
+import time
+import zlib
+
+
+class ResponseArchive:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+
+    def __init__(self, config):
+        self.enabled = config.read_config('RIA_CONFIG', 'archive_responses').lower() in ('yes', 'true', 'on', '1')
+        self.location = os.path.join(config.read_config('RIA_CONFIG', 'cache_files_location'), 'archive')
+        self.segment_rows = int(config.read_config('RIA_CONFIG', 'archive_segment_rows'))
+        self.write_lock = threading.Lock()
+        # Open segment and number of records in it per kind
+        self.segments = {}
+        self.sequence = 0
+        if self.enabled:
+            atexit.register(self.close)
+
+    @classmethod
+    def shared(cls, config):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(config)
+        return cls.instance
+
+    def add(self, kind, key, data):
+        if not self.enabled:
+            return
+        record = json.dumps({'key': key, 'stored': time.time(), 'data': data}, ensure_ascii=False)
+        with self.write_lock:
+            segment, rows = self.segments.get(kind) or (self.open_segment(kind), 0)
+            segment.write(record + '\n')
+            rows += 1
+            if rows >= self.segment_rows:
+                segment.close()
+                self.segments.pop(kind)
+            else:
+                self.segments[kind] = (segment, rows)
+
+    def open_segment(self, kind):
+        # Segments are never appended to once closed, every run starts new ones
+        if not os.path.isdir(self.location):
+            os.makedirs(self.location)
+        self.sequence += 1
+        name = '%s_%s_%s_%04d.jsonl.gz' % (kind, time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.sequence)
+        return gzip.open(os.path.join(self.location, name), 'wt', encoding='utf8')
+
+    def close(self):
+        with self.write_lock:
+            for segment, rows in self.segments.values():
+                segment.close()
+            self.segments = {}
+
+    def segment_paths(self, kind):
+        # Oldest first, names start with creation time
+        return sorted(glob.glob(os.path.join(self.location, '%s_*.jsonl.gz' % kind)))
+
+    def reprocess(self, plan_args, extraction, filters, workers=None):
+        # Cars of all archived details responses extracted again, segments are parsed by all cores at once
+        paths = self.segment_paths('info')
+        rows = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [(path, plan_args, extraction, filters) for path in paths]
+            for path, (extracted, complete) in zip(paths, executor.map(extract_segment, jobs)):
+                if not complete:
+                    self.logger.warning('Archive segment %s is truncated, read %s cars' % (path, len(extracted)))
+                self.logger.debug("Extracted %s cars from %s" % (len(extracted), path))
+                # Latest archived response of a car wins
+                for auto_id, row in extracted:
+                    rows.pop(auto_id, None)
+                    rows[auto_id] = row
+        return list(rows.values())
+
+
+def extract_segment(job):
+    # Runs in a worker process, returns (auto id, output row) for cars matching filters and if segment was read whole
+    path, plan_args, extraction, filters = job
+    plan = ExtractionPlan(*plan_args)
+    extracted = []
+    try:
+        with gzip.open(path, 'rt', encoding='utf8') as segment:
+            for line in segment:
+                record = json.loads(line)
+                data = record['data']
+                if any(data.get(key) != value for (key, value) in filters.items()):
+                    continue
+                info = flatten(data) if extraction == 'flatten' else plan.select(data)
+                extracted.append((str(record['key']), plan.extract(info)))
+    except (EOFError, OSError, zlib.error, ValueError):
+        # Segment of an interrupted run ends with a partly written record
+        return extracted, False
+    return extracted, True
@@ -0,0 +1,167 @@
+import atexit
+import collections
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class CacheStore:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+    # Entries kept in memory in front of the database
+    memo_entries = 256
+
+    def __init__(self, config):
+        location = config.read_config('RIA_CONFIG', 'cache_files_location')
+        self.path = os.path.join(location, 'cache.sqlite')
+        self.default_ttl = int(config.read_config('RIA_CONFIG', 'cache_expiry_time'))
+        # Namespaces with a TTL of their own, 0 never expires
+        self.ttls = {k: int(v) for (k, v) in config.read_config('CACHE_TTL').items()}
+        self.size_limit = int(float(config.read_config('RIA_CONFIG', 'cache_size_limit')) * 1024 * 1024)
+        if not os.path.isdir(location):
+            os.mkdir(location)
+        self.db_lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        # Space of evicted entries is given back to the file system, older files are converted once
+        if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            self.db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.db.execute('VACUUM')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                        'namespace TEXT, '
+                        'key TEXT, '
+                        'value BLOB, '
+                        'stored REAL, '
+                        'accessed REAL, '
+                        'size INTEGER, '
+                        'PRIMARY KEY (namespace, key))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.memo = collections.OrderedDict()
+        # Read times of entries not stored yet, written in batches
+        self.touched = []
+        atexit.register(self.close)
+
+    @classmethod
+    def shared(cls, config):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(config)
+        return cls.instance
+
+    def ttl(self, namespace):
+        return self.ttls.get(namespace, self.default_ttl)
+
+    def entry(self, namespace, key):
+        # Value and store time, None if there is no entry
+        key = str(key)
+        with self.db_lock:
+            entry = self.memo.get((namespace, key))
+            if entry is None:
+                row = self.db.execute('SELECT value, stored FROM entries WHERE namespace = ? AND key = ?',
+                                      (namespace, key)).fetchone()
+                if row is None:
+                    return None
+                try:
+                    entry = (pickle.loads(row[0]), row[1])
+                except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+                    self.logger.warning('Dropped unreadable "%s" cache entry %s' % (namespace, key))
+                    self.delete(namespace, key)
+                    return None
+            self.remember(namespace, key, entry)
+            self.touched.append((time.time(), namespace, key))
+            if len(self.touched) >= self.memo_entries:
+                self.touch()
+            return entry
+
+    def get(self, namespace, key, ttl=None):
+        # Cached value, None if missing or older than ttl seconds (0 or None never expires)
+        entry = self.entry(namespace, key)
+        if entry is None:
+            return None
+        value, stored = entry
+        if ttl and time.time() - stored >= ttl:
+            return None
+        return value
+
+    def age(self, namespace, key):
+        entry = self.entry(namespace, key)
+        if entry is None:
+            return None
+        return time.time() - entry[1]
+
+    def put(self, namespace, key, value):
+        key = str(key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.db_lock:
+            # Single transaction, an interrupted write leaves the previous value in place
+            with self.db:
+                previous = self.db.execute('SELECT size FROM entries WHERE namespace = ? AND key = ?',
+                                           (namespace, key)).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO entries (namespace, key, value, stored, accessed, size) '
+                                'VALUES (?, ?, ?, ?, ?, ?)', (namespace, key, data, now, now, len(data)))
+            self.size += len(data) - (previous[0] if previous else 0)
+            self.remember(namespace, key, (value, now))
+            if self.size_limit and self.size > self.size_limit:
+                self.evict()
+
+    def delete(self, namespace, key):
+        key = str(key)
+        with self.db_lock:
+            with self.db:
+                row = self.db.execute('SELECT size FROM entries WHERE namespace = ? AND key = ?',
+                                      (namespace, key)).fetchone()
+                self.db.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+            if row:
+                self.size -= row[0]
+            self.memo.pop((namespace, key), None)
+
+    def touch(self):
+        with self.db_lock:
+            if self.touched:
+                with self.db:
+                    self.db.executemany('UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?',
+                                        self.touched)
+                self.touched = []
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.touch()
+                self.db.close()
+                self.db = None
+                atexit.unregister(self.close)
+
+    def evict(self):
+        # Drop least recently read entries until the store is 10% below its size limit, entries which never
+        # expire (e.g. delta ids and request history) are kept
+        target = self.size_limit * 0.9
+        evicted = 0
+        with self.db_lock:
+            self.touch()
+            rows = self.db.execute('SELECT namespace, key, size FROM entries ORDER BY accessed').fetchall()
+            with self.db:
+                for namespace, key, size in rows:
+                    if self.size <= target:
+                        break
+                    if not self.ttl(namespace):
+                        continue
+                    self.db.execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (namespace, key))
+                    self.memo.pop((namespace, key), None)
+                    self.size -= size
+                    evicted += 1
+            self.db.execute('PRAGMA incremental_vacuum')
+        self.logger.debug('Evicted %s cache entries, cache size is %s bytes' % (evicted, self.size))
+
+    def remember(self, namespace, key, entry):
+        self.memo[(namespace, key)] = entry
+        self.memo.move_to_end((namespace, key))
+        while len(self.memo) > self.memo_entries:
+            self.memo.popitem(last=False)
@@ -1,17 +1,50 @@
+from src.cache import CacheStore
 from src.log import RiaLogger
 import collections
 import configparser
 import os
 import pickle
-import time
+import threading
+import types
 
 
 class Config:
+    lock = threading.Lock()
+    instance = None
 
     def __init__(self):
         self.parser = configparser.ConfigParser()
         self.file = os.path.join('config', 'ria.ini')
+        self.key_file = os.path.join('config', 'key.pkl')
         self.store_default_config()
+        self.mtime = None
+        self.sections = self.load_config()
+        self.fields_to_extract = self.load_fields_to_extract()
+        self.key = None
+        self.store = None
+
+    @classmethod
+    def shared(cls):
+        # One parsed configuration per process
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls()
+        return cls.instance
+
+    def reload(self, force=False):
+        # Re-read config file if it was changed since it was loaded
+        if force or os.path.getmtime(self.file) != self.mtime:
+            self.sections = self.load_config()
+            self.fields_to_extract = self.load_fields_to_extract()
+            RiaLogger.log("Reloaded config '%s'" % self.file, suppress_stdout=True)
+            return True
+        return False
+
+    @property
+    def api_key(self):
+        if self.key is None:
+            self.key = self.get_api_key(self.key_file)
+        return self.key
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -20,27 +53,38 @@ class Config:
         setattr(self, item, value)
 
     def store_default_config(self):
-        sections = ['RIA_CONFIG', 'OUTPUT']
+        sections = ['RIA_CONFIG', 'OUTPUT', 'TIMEOUTS', 'CACHE_TTL']
         if not os.path.isfile(self.file):
             if not os.path.isdir('config'):
                 os.mkdir('config')
             for section in sections:
                 self.parser.add_section(section)
             self.parser.set("OUTPUT", "fields", ",".join(self.convert_field.values()))
-            self.parser.set('RIA_CONFIG', 'search_results_location', 'results/')
-            self.parser.set('RIA_CONFIG', 'cache_files_location', 'tmp/')
-            self.parser.set('RIA_CONFIG', 'cache_expiry_time', '86400')
-            self.parser.set('RIA_CONFIG', 'output_format', 'csv')
+            for section, params in self.defaults.items():
+                for param, value in params.items():
+                    self.parser.set(section, param, value)
             with open(self.file, 'w') as configfile:
                 self.parser.write(configfile)
             RiaLogger.log("Default config is stored into '%s'" % self.file)
 
+    def load_config(self):
+        parser = configparser.ConfigParser()
+        self.mtime = os.path.getmtime(self.file)
+        parser.read(self.file)
+        sections = {}
+        for section in set(parser.sections()) | set(self.defaults):
+            # Fall back to defaults for options missing in older config files
+            items = dict(self.defaults.get(section, {}))
+            if parser.has_section(section):
+                items.update(parser.items(section))
+            sections[section] = types.MappingProxyType(items)
+        return types.MappingProxyType(sections)
+
     def read_config(self, section, param=None):
-        self.parser.read(self.file)
         if param:
-            return self.parser.get(section, param)
+            return self.sections[section][param]
         else:
-            return dict(self.parser.items(section))
+            return self.sections[section]
 
     @staticmethod
     def get_api_key(f='config/key.pkl'):
@@ -64,6 +108,9 @@ class Config:
         RiaLogger.log("Stored api key '%s' successfully" % f)
 
     def get_fields_to_extract(self):
+        return self.fields_to_extract
+
+    def load_fields_to_extract(self):
         ria_fields_to_extract = []
         fields = self.read_config('OUTPUT', 'fields')
         fields_enabled = fields.split(',')
@@ -73,53 +120,85 @@ class Config:
                 if tgt == df:
                     ria_fields_to_extract.append(src)
                     break
-        return ria_fields_to_extract
-
-    def store_cache_data(self, data, pkl_name, suffix=None):
-        location = self.read_config('RIA_CONFIG', 'cache_files_location')
-        if not os.path.isdir(location):
-            os.mkdir(location)
-        pkl_path = self.get_cache_path(location, pkl_name, suffix)
-
-        with open(pkl_path, 'wb') as pkl:
-            pickle.dump(data, pkl, pickle.HIGHEST_PROTOCOL)
-        RiaLogger.log('Stored "%s" cache file successfully' % pkl_path, suppress_stdout=True)
-
-    def get_cache_data(self, pkl_name, suffix=None):
-        location = self.read_config('RIA_CONFIG', 'cache_files_location')
-        pkl_path = self.get_cache_path(location, pkl_name, suffix)
-
-        with open(pkl_path, 'rb') as data:
-            RiaLogger.log('Loading data from "%s" cache file' % pkl_path, suppress_stdout=True)
-            return pickle.load(data)
-
-    def cache_valid(self, pkl_name, suffix=None):
-        location = self.read_config('RIA_CONFIG', 'cache_files_location')
-        ttl = int(self.read_config('RIA_CONFIG', 'cache_expiry_time'))
-        pkl_path = self.get_cache_path(location, pkl_name, suffix)
-
-        if os.path.isfile(pkl_path):
-            t = time.time()
-            mtime = os.path.getmtime(pkl_path)
-            cache_age = t - mtime
-            if cache_age < ttl:
-                RiaLogger.log('"%s" cache data is valid, TTL is %s seconds' % (pkl_path, round(ttl-cache_age, 2)),
-                              suppress_stdout=True)
-                return True
-            else:
-                RiaLogger.log('"%s" cache is expired' % pkl_path, suppress_stdout=True)
-                return False
-        else:
-            RiaLogger.log('"%s" cache file not found' % pkl_path, suppress_stdout=True)
+        return tuple(ria_fields_to_extract)
+
+    @property
+    def cache(self):
+        if self.store is None:
+            self.store = CacheStore.shared(self)
+        return self.store
+
+    def store_cache_data(self, data, name, suffix=None):
+        self.cache.put(name, suffix or '', data)
+        RiaLogger.log('Stored "%s" cache data %s' % (name, suffix or ''), suppress_stdout=True)
+
+    def get_cache_data(self, name, suffix=None):
+        # Cached data regardless of its age, None if there is none
+        return self.cache.get(name, suffix or '')
+
+    def cache_valid(self, name, suffix=None):
+        ttl = self.cache.ttl(name)
+        age = self.cache.age(name, suffix or '')
+        if age is None:
+            RiaLogger.log('"%s" cache data %s not found' % (name, suffix or ''), suppress_stdout=True)
             return False
-
-    @staticmethod
-    def get_cache_path(location, cache_name, suffix):
-        separator = '_'
-        if suffix:
-            return os.path.join(location, cache_name + separator + str(suffix) + '.pkl')
-        else:
-            return os.path.join(location, cache_name + '.pkl')
+        if not ttl or age < ttl:
+            RiaLogger.log('"%s" cache data %s is valid, TTL is %s seconds' % (name, suffix or '',
+                                                                             round(ttl - age, 2) if ttl else '-'),
+                          suppress_stdout=True)
+            return True
+        RiaLogger.log('"%s" cache data %s is expired' % (name, suffix or ''), suppress_stdout=True)
+        return False
+
+    defaults = {
+        'RIA_CONFIG': collections.OrderedDict(
+            [
+                ('search_results_location', 'results/'),
+                ('cache_files_location', 'tmp/'),
+                ('cache_expiry_time', '86400'),
+                ('catalog_max_age', '2592000'),
+                ('output_format', 'csv'),
+                ('workers', '8'),
+                ('page_workers', '4'),
+                ('batch_workers', '4'),
+                ('partition_threshold', '2000'),
+                ('pool_size', '10'),
+                ('requests_per_hour', '1000'),
+                ('max_retries', '5'),
+                ('extraction', 'paths'),
+                ('details_cache_expiry_time', '3600'),
+                ('cache_size_limit', '200'),
+                ('output_flush_rows', '100'),
+                ('parquet_row_group', '10000'),
+                ('results_database', 'results.sqlite'),
+                ('average_price_max_age', '604800'),
+                ('average_price_min_cars', '10'),
+                ('log_format', 'text'),
+                ('log_payload_items', '100'),
+                ('log_sample_rate', '1'),
+                ('api_url', 'https://developers.ria.com'),
+                ('archive_responses', 'no'),
+                ('archive_segment_rows', '5000'),
+            ]
+        ),
+        # Request timeouts in seconds per API endpoint
+        'TIMEOUTS': collections.OrderedDict(
+            [
+                ('default', '10'),
+                ('catalog', '10'),
+                ('search', '10'),
+                ('info', '10'),
+                ('average_price', '10'),
+            ]
+        ),
+        # Cache expiry time in seconds per cached data kind, others use 'cache_expiry_time', 0 never expires
+        'CACHE_TTL': collections.OrderedDict(
+            [
+                ('delta', '0'),
+                ('rate_limit', '0'),
+            ]
+        )
+    }
 
     convert_field = collections.OrderedDict(
             {
@@ -0,0 +1,53 @@
+import collections
+import logging
+
+
+class DeltaSearch:
+    logger = logging.getLogger("ria.run")
+
+    def __init__(self, config, key):
+        self.config = config
+        self.key = key
+        self.previous = self.load()
+        self.added = []
+        self.removed = []
+
+    def load(self):
+        # Ids found by the previous run with the same criteria
+        return self.config.get_cache_data('delta', self.key)
+
+    def save(self, ads_ids):
+        self.config.store_cache_data(list(ads_ids), 'delta', self.key)
+
+    def compare(self, ads_ids):
+        previous = self.previous or []
+        previous_set = set(previous)
+        current_set = set(ads_ids)
+        self.added = [i for i in ads_ids if i not in previous_set]
+        self.removed = [i for i in previous if i not in current_set]
+        if self.previous is None:
+            self.logger.info('No previous search by given criteria, all %s cars are new' % len(self.added))
+        else:
+            self.logger.info('%s new and %s removed cars since previous search' % (len(self.added),
+                                                                                  len(self.removed)))
+        return self.added
+
+    def removed_rows(self, plan, details_cache):
+        rows = []
+        for ria_id in self.removed:
+            # Last known details of removed cars if still cached
+            info = details_cache.get(ria_id, plan.fields, fresh=False)
+            if info is not None:
+                rows.append(self.row('removed', plan.extract(info)))
+            else:
+                src_set = collections.OrderedDict((column, '-') for column in plan.columns)
+                if 'id' in src_set:
+                    src_set['id'] = ria_id
+                rows.append(self.row('removed', src_set))
+        return rows
+
+    @staticmethod
+    def row(status, src_set):
+        row = collections.OrderedDict([('status', status)])
+        row.update(src_set)
+        return row
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+
+
+class DetailCache:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+    listing_columns = ('marka_id', 'model_id', 'gear_id', 'yers', 'fuel_id', 'usd')
+
+    def __init__(self, config):
+        self.ttl = int(config.read_config('RIA_CONFIG', 'details_cache_expiry_time'))
+        # Details are kept in the common cache store, average price listings in a table next to it even if
+        # details are not cached
+        self.store = config.cache
+        with self.store.db_lock:
+            self.store.db.execute('CREATE TABLE IF NOT EXISTS listings ('
+                                  'auto_id TEXT PRIMARY KEY, '
+                                  'marka_id INTEGER, '
+                                  'model_id INTEGER, '
+                                  'gear_id INTEGER, '
+                                  'yers INTEGER, '
+                                  'fuel_id INTEGER, '
+                                  'usd REAL, '
+                                  'stored REAL)')
+            # Listings too old for average prices are never read again
+            max_age = int(config.read_config('RIA_CONFIG', 'average_price_max_age'))
+            self.store.db.execute('DELETE FROM listings WHERE stored < ?', (time.time() - max_age,))
+            self.store.db.commit()
+
+    @classmethod
+    def shared(cls, config):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(config)
+        return cls.instance
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, auto_id, fields, fresh=True):
+        # Cached source values of a car, None if missing, expired or stored for other fields. Search results
+        # give only ids, so cars updated on RIA are noticed only once their details expire
+        if not self.enabled:
+            return None
+        entry = self.store.get('details', auto_id, self.ttl if fresh else None)
+        if entry is None:
+            return None
+        stored_fields, info = entry
+        if stored_fields != ','.join(fields):
+            return None
+        return info
+
+    def put(self, auto_id, fields, info, listing=None):
+        if self.enabled:
+            info = {k: info[k] for k in fields if k in info}
+            self.store.put('details', auto_id, (','.join(fields), info))
+        if listing is not None:
+            with self.store.db_lock, self.store.db:
+                self.store.db.execute('INSERT OR REPLACE INTO listings (auto_id, %s, stored) VALUES (?, %s, ?)' % (
+                    ', '.join(self.listing_columns), ', '.join('?' * len(self.listing_columns))),
+                    [str(auto_id)] + [listing.get(c) for c in self.listing_columns] + [time.time()])
+
+    def prices(self, criteria, max_age):
+        # Prices in USD of cars downloaded within max_age seconds matching average price criteria
+        conditions = ['usd IS NOT NULL', 'stored > ?']
+        values = [time.time() - max_age]
+        for column in self.listing_columns:
+            if criteria.get(column) is not None:
+                conditions.append('%s = ?' % column)
+                values.append(criteria[column])
+        with self.store.db_lock:
+            rows = self.store.db.execute('SELECT usd FROM listings WHERE %s' % ' AND '.join(conditions),
+                                         values).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,130 @@
+import collections
+
+
+class ExtractionPlan:
+    # Average price criteria of a car and its price, stored to compute average prices locally
+    listing_paths = (('marka_id', ('markId',)),
+                     ('model_id', ('modelId',)),
+                     ('gear_id', ('autoData', 'gearBoxId')),
+                     ('yers', ('autoData', 'year')),
+                     ('fuel_id', ('autoData', 'fuelId')),
+                     ('usd', ('USD',)))
+
+    def __init__(self, fields, convert_field, bodies, ria_url):
+        self.ria_url = ria_url
+        self.fields = tuple(fields)
+        # Body style id to name, first name wins as in body styles catalog order
+        self.body_names = {}
+        for name, body_id in bodies.items():
+            self.body_names.setdefault(body_id, name)
+        self.steps = tuple((src, convert_field[src], self.get_transform(src)) for src in fields)
+        self.columns = self.get_columns()
+        # Flattened field names split into JSON path tokens, e.g. 'autoData_raceInt' -> ('autoData', 'raceInt')
+        self.paths = tuple((src, tuple(src.split(self.separator))) for src in fields)
+
+    def get_transform(self, src):
+        name = self.transforms.get(src)
+        if name:
+            return getattr(self, name)
+        return None
+
+    def get_columns(self):
+        columns = []
+        for src, tgt, transform in self.steps:
+            if src == 'autoData_fuelName':
+                columns.append('displacement')
+            columns.append(tgt)
+        return columns
+
+    def select(self, ria_adv):
+        # Walk only paths of configured fields, same keys and values as flatten() would give
+        selected = {}
+        for src, tokens in self.paths:
+            found, value = self.resolve(ria_adv, tokens, 0)
+            if found:
+                selected[src] = value
+        return selected
+
+    def listing(self, ria_adv):
+        listing = {}
+        for column, tokens in self.listing_paths:
+            found, value = self.resolve(ria_adv, tokens, 0)
+            listing[column] = value if found else None
+        return listing
+
+    def resolve(self, node, tokens, start):
+        if start == len(tokens):
+            # flatten() keeps only leaves and empty containers
+            if isinstance(node, (dict, list, set, tuple)) and node:
+                return False, None
+            return True, node
+        if isinstance(node, dict):
+            # Keys may contain the separator themselves, try the shortest key first
+            for end in range(start + 1, len(tokens) + 1):
+                key = self.separator.join(tokens[start:end])
+                if key in node:
+                    found, value = self.resolve(node[key], tokens, end)
+                    if found:
+                        return found, value
+        elif isinstance(node, (list, tuple)) and tokens[start].isdigit():
+            index = int(tokens[start])
+            if index < len(node):
+                return self.resolve(node[index], tokens, start + 1)
+        return False, None
+
+    def extract(self, ria_adv_flat):
+        src_set = collections.OrderedDict()
+        for src_el, tgt_el, transform in self.steps:
+            if src_el in ria_adv_flat:
+                src_val = ria_adv_flat[src_el]
+                if transform:
+                    src_val = transform(src_val, src_set)
+                src_set[tgt_el] = src_val
+            else:
+                src_set[tgt_el] = '-'
+        return src_set
+
+    def extract_batch(self, ria_adv_flats):
+        extract = self.extract
+        return [extract(ria_adv_flat) for ria_adv_flat in ria_adv_flats]
+
+    @staticmethod
+    def mileage(src_val, src_set):
+        # Multiply mileage value by 1000
+        return src_val * 1000
+
+    @staticmethod
+    def fuel(src_val, src_set):
+        # Check if Fuel field contains engine volume info
+        if any(char.isdigit() for char in src_val):
+            if ',' in src_val:
+                fuel_info = src_val.split(',')
+                src_set['displacement'] = fuel_info[1].split()[0]
+                return fuel_info[0]
+            else:
+                src_set['displacement'] = src_val.split()[0]
+                return '-'
+        src_set['displacement'] = '-'
+        return src_val
+
+    def body(self, src_val, src_set):
+        # set body type from response
+        return self.body_names.get(src_val, '-')
+
+    def url(self, src_val, src_set):
+        return self.ria_url + src_val
+
+    @staticmethod
+    def description(src_val, src_set):
+        # dispose of new line in description
+        return src_val.replace('\r', '').replace('\n', '')
+
+    separator = '_'
+
+    transforms = {
+        'autoData_raceInt': 'mileage',
+        'autoData_fuelName': 'fuel',
+        'autoData_bodyId': 'body',
+        'linkToView': 'url',
+        'autoData_description': 'description',
+    }
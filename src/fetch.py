@@ -0,0 +1,109 @@
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+from src.config import Config
+from src.metrics import RunMetrics
+from src.search import VehicleDetails
+import logging
+import threading
+from tqdm import tqdm
+
+
+class DetailRegistry:
+    # Cars being downloaded by all searches of the process, a car found by several of them is downloaded once
+    lock = threading.Lock()
+    instance = None
+
+    def __init__(self):
+        self.registry_lock = threading.Lock()
+        self.fetches = {}
+        # Keep downloaded cars for searches started later, e.g. other searches of a batch
+        self.retain = False
+        self.metrics = RunMetrics.shared()
+
+    @classmethod
+    def shared(cls):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls()
+        return cls.instance
+
+    def fetch(self, advertisement):
+        key = (str(advertisement.id), tuple(advertisement.plan.columns))
+        with self.registry_lock:
+            fetch = self.fetches.get(key)
+            if fetch is None:
+                fetch = self.fetches[key] = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            advertisement.code, advertisement.csv, advertisement.failed = fetch.result()
+            self.metrics.cache('shared details', True)
+            return advertisement
+        try:
+            advertisement.get()
+        except BaseException as e:
+            with self.registry_lock:
+                self.fetches.pop(key, None)
+            fetch.set_exception(e)
+            raise
+        # Failed cars are downloaded again by searches started later
+        if advertisement.failed or not self.retain:
+            with self.registry_lock:
+                self.fetches.pop(key, None)
+        # Only the output row is kept, not the car details and request parameters
+        fetch.set_result((advertisement.code, advertisement.csv, advertisement.failed))
+        return advertisement
+
+
+class DetailFetcher:
+    logger = logging.getLogger("ria.run")
+
+    def __init__(self, bodies, workers=None):
+        self.config = Config.shared()
+        self.bodies = bodies
+        self.plan = VehicleDetails.compile_plan(self.config, bodies)
+        if workers:
+            self.workers = workers
+        else:
+            self.workers = int(self.config.read_config('RIA_CONFIG', 'workers'))
+        self.metrics = RunMetrics.shared()
+        self.registry = DetailRegistry.shared()
+        self.stop = threading.Event()
+        self.failed = False
+
+    def get(self, advertisement):
+        # Skip remaining downloads once one of the requests failed
+        if self.stop.is_set():
+            return advertisement
+        self.registry.fetch(advertisement)
+        if advertisement.failed:
+            self.failed = True
+            self.stop.set()
+        return advertisement
+
+    def submit(self, executor, ria_id, progress):
+        future = executor.submit(self.metrics.profiled(self.get), VehicleDetails(ria_id, self.bodies, self.plan))
+        future.add_done_callback(lambda f: progress.update())
+        return future
+
+    def iter_fetch(self, ads_ids):
+        self.logger.debug("Downloading details for %s cars using %s workers" % (len(ads_ids), self.workers))
+        # Yield cars in search order while keeping a bounded number of downloads in flight
+        window = self.workers * 4
+        ids = iter(ads_ids)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with tqdm(total=len(ads_ids), desc='Downloading cars info', unit='cars') as progress:
+                pending = collections.deque(self.submit(executor, ria_id, progress)
+                                            for ria_id in itertools.islice(ids, window))
+                while pending:
+                    # Time spent waiting for downloads
+                    with self.metrics.stage('details'):
+                        advertisement = pending.popleft().result()
+                    for ria_id in itertools.islice(ids, 1):
+                        pending.append(self.submit(executor, ria_id, progress))
+                    yield advertisement
+
+    def fetch(self, ads_ids):
+        return list(self.iter_fetch(ads_ids))
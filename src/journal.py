@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+
+
+class RunJournal:
+    logger = logging.getLogger("ria.run")
+
+    def __init__(self, config, key):
+        location = config.read_config('RIA_CONFIG', 'cache_files_location')
+        if not os.path.isdir(location):
+            os.mkdir(location)
+        self.path = os.path.join(location, 'journal_%s.json' % key)
+        self.state = None
+        self.position = 0
+
+    def load(self):
+        # State of an interrupted search with the same criteria, None if there is none
+        try:
+            with open(self.path, 'r') as journal:
+                self.state = json.load(journal)
+        except (IOError, ValueError):
+            return None
+        self.position = self.state['committed']
+        return self.state
+
+    def start(self, criteria, ads_ids, output_time, part_path, header, delta=None):
+        # New search drops unfinished file of the previous one
+        previous = self.load()
+        if previous and previous['part_path'] != part_path and os.path.isfile(previous['part_path']):
+            os.remove(previous['part_path'])
+            self.logger.info('Dropped interrupted search results %s' % previous['part_path'])
+        self.state = {
+            'criteria': criteria,
+            'ids': ads_ids,
+            'time': output_time,
+            'part_path': part_path,
+            # Columns of the output file, a search with other columns cannot continue it
+            'header': list(header),
+            # Ids found and removed since previous delta search
+            'found': delta[0] if delta else None,
+            'removed': delta[1] if delta else None,
+            # Cars written to the output file and its size when it was flushed last time
+            'committed': 0,
+            'count': 0,
+            'offset': None
+        }
+        self.position = 0
+        self.save()
+
+    def advance(self):
+        self.position += 1
+
+    def commit(self, count, offset):
+        self.state['committed'] = self.position
+        self.state['count'] = count
+        self.state['offset'] = offset
+        self.save()
+
+    def save(self):
+        # Replace journal atomically so an interrupted write never leaves it half written
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            json.dump(self.state, journal, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.state = None
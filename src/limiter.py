@@ -0,0 +1,105 @@
+import atexit
+import collections
+import logging
+import threading
+import time
+
+
+class RateLimiter:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+    window = 3600
+
+    def __init__(self, config):
+        self.config = config
+        self.budget = int(config.read_config('RIA_CONFIG', 'requests_per_hour'))
+        self.max_retries = int(config.read_config('RIA_CONFIG', 'max_retries'))
+        # Token bucket refilled at the hourly budget rate, slowed down on 429/403 responses
+        self.base_rate = self.budget / float(self.window)
+        self.rate = self.base_rate
+        self.min_rate = self.base_rate / 16
+        self.history = self.load_history()
+        self.tokens = float(max(self.budget - len(self.history), 0))
+        self.updated = time.time()
+        self.server_remaining = None
+        self.bucket_lock = threading.Lock()
+        atexit.register(self.save_history)
+
+    @classmethod
+    def shared(cls, config):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(config)
+        return cls.instance
+
+    def load_history(self):
+        # Timestamps of requests sent within the last hour, kept between runs
+        history = self.config.get_cache_data('rate_limit') or []
+        now = time.time()
+        return collections.deque(t for t in history if now - t < self.window)
+
+    def save_history(self):
+        with self.bucket_lock:
+            self.expire_history(time.time())
+            history = list(self.history)
+        self.config.store_cache_data(history, 'rate_limit')
+
+    def expire_history(self, now):
+        while self.history and now - self.history[0] >= self.window:
+            self.history.popleft()
+
+    def refill(self, now):
+        self.tokens = min(float(self.budget), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.bucket_lock:
+                now = time.time()
+                self.refill(now)
+                self.expire_history(now)
+                if len(self.history) >= self.budget:
+                    # Hourly budget is used up, wait until the oldest request leaves the window
+                    wait = self.history[0] + self.window - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.history.append(now)
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            self.logger.debug("Request budget exhausted, waiting %.2f seconds" % wait)
+            time.sleep(wait)
+
+    def penalize(self, attempt, retry_after=None):
+        # Multiplicative decrease: empty the bucket and halve the refill rate
+        with self.bucket_lock:
+            self.refill(time.time())
+            self.tokens = 0.0
+            self.rate = max(self.min_rate, self.rate / 2)
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return min(2 ** (attempt + 1), 60)
+
+    def recover(self, response):
+        with self.bucket_lock:
+            # Additive increase back to the configured rate
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 16)
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining and remaining.isdigit():
+                self.server_remaining = int(remaining)
+
+    def remaining(self):
+        with self.bucket_lock:
+            self.expire_history(time.time())
+            remaining = self.budget - len(self.history)
+        if self.server_remaining is not None:
+            remaining = min(remaining, self.server_remaining)
+        return max(remaining, 0)
+
+    def estimate(self, requests_count):
+        # Seconds needed to send given number of requests within the budget
+        backlog = requests_count - self.remaining()
+        if backlog <= 0:
+            return 0
+        return backlog / self.rate
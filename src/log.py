@@ -1,4 +1,66 @@
+import atexit
+import itertools
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+
+
+class LazyJson:
+    # JSON dump of a logged payload, made only if the record is written
+    items = 100
+
+    def __init__(self, data, indent=2, sep=(',', ':'), data_type=None):
+        self.data = data
+        self.indent = indent
+        self.sep = sep
+        self.data_type = data_type
+
+    def value(self):
+        data = self.data
+        if self.data_type == 'list':
+            data = list(data)
+        if self.data_type == 'dict':
+            data = dict(data)
+        # Long lists like search result ids are cut to the first items
+        if self.items and isinstance(data, list) and len(data) > self.items:
+            data = data[:self.items] + ['... %s more' % (len(data) - self.items)]
+        return data
+
+    def __str__(self):
+        return json.dumps(self.value(), ensure_ascii=False, indent=self.indent, sort_keys=True,
+                          separators=self.sep, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per record, payloads are kept as JSON values instead of dumped strings
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, RiaLogger.log_date_format),
+            'msecs': int(record.msecs),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': None
+        }
+        args = record.args if isinstance(record.args, tuple) else (record.args,) if record.args else ()
+        if any(isinstance(a, LazyJson) for a in args):
+            # Message template with its arguments, payloads are not dumped into the message
+            entry['message'] = str(record.msg)
+            entry['args'] = [a.value() if isinstance(a, LazyJson) else a for a in args]
+        else:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Records are formatted by the listener thread, not by the thread which logs them
+
+    def prepare(self, record):
+        return record
 
 
 class RiaLogger:
@@ -7,6 +69,43 @@ class RiaLogger:
     log_filename = 'ria.log'
     log_date_format = '%Y-%m-%d %H:%M:%S'
     logger = logging.getLogger("ria.run")
+    file_handler = None
+    listener = None
+    sample_rate = 1
+    samples = itertools.count()
+    # Messages for the user go to stderr while stdout carries search results
+    messages = None
+
+    @classmethod
+    def start(cls):
+        # Log file is written by a background thread so logging never waits for disk
+        cls.file_handler = logging.FileHandler(cls.log_filename)
+        cls.file_handler.setFormatter(logging.Formatter(cls.log_format_info))
+        records = queue.Queue()
+        cls.listener = logging.handlers.QueueListener(records, cls.file_handler)
+        cls.listener.start()
+        cls.logger.addHandler(DeferredQueueHandler(records))
+        atexit.register(cls.stop)
+
+    @classmethod
+    def stop(cls):
+        if cls.listener is not None:
+            cls.listener.stop()
+            cls.listener = None
+
+    @classmethod
+    def configure(cls, config):
+        if config.read_config('RIA_CONFIG', 'log_format') == 'json':
+            cls.file_handler.setFormatter(JsonFormatter())
+        LazyJson.items = int(config.read_config('RIA_CONFIG', 'log_payload_items'))
+        cls.sample_rate = int(config.read_config('RIA_CONFIG', 'log_sample_rate'))
+
+    @classmethod
+    def sampled(cls):
+        # Whether payload of a car should be logged, one of each sample_rate cars
+        if not cls.logger.isEnabledFor(logging.DEBUG):
+            return False
+        return cls.sample_rate > 0 and next(cls.samples) % cls.sample_rate == 0
 
     @classmethod
     def log(cls, message, level='debug', suppress_stdout=False):
@@ -19,5 +118,9 @@ class RiaLogger:
         elif level == 'debug':
             cls.logger.debug(message)
         if not suppress_stdout:
-            if message is not '':
-                print(message)
+            if message != '':
+                cls.echo(message)
+
+    @classmethod
+    def echo(cls, message, end='\n'):
+        print(message, end=end, file=cls.messages or sys.stdout)
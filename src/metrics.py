@@ -0,0 +1,158 @@
+import atexit
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import pstats
+from src.stats import import_numpy
+import tabulate
+import threading
+import time
+
+
+class RunMetrics:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+    # Stages of a search in the order they run
+    stages = ('catalog', 'pagination', 'details', 'extraction', 'output')
+
+    def __init__(self):
+        self.metrics_lock = threading.Lock()
+        self.times = collections.OrderedDict((stage, 0.0) for stage in self.stages)
+        self.latencies = collections.defaultdict(list)
+        self.sizes = collections.defaultdict(int)
+        self.retries = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+        self.hits = collections.defaultdict(int)
+        self.misses = collections.defaultdict(int)
+        self.profile_path = None
+        self.profiles = []
+        self.thread_profile = threading.local()
+
+    @classmethod
+    def shared(cls):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls()
+        return cls.instance
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.metrics_lock:
+                self.times[name] += elapsed
+
+    def request(self, endpoint, seconds, size):
+        with self.metrics_lock:
+            self.latencies[endpoint].append(seconds)
+            self.sizes[endpoint] += size
+
+    def retry(self, endpoint):
+        with self.metrics_lock:
+            self.retries[endpoint] += 1
+
+    def error(self, endpoint):
+        with self.metrics_lock:
+            self.errors[endpoint] += 1
+
+    def cache(self, name, hit):
+        with self.metrics_lock:
+            if hit:
+                self.hits[name] += 1
+            else:
+                self.misses[name] += 1
+
+    def summary(self):
+        numpy = import_numpy()
+        requests = collections.OrderedDict()
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = numpy.array(self.latencies[endpoint]) * 1000
+            p50, p95, p99 = numpy.percentile(latencies, (50, 95, 99)) if len(latencies) else (numpy.nan,) * 3
+            requests[endpoint] = {'count': len(latencies), 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                                  'bytes': self.sizes[endpoint], 'retries': self.retries[endpoint],
+                                  'errors': self.errors[endpoint]}
+        caches = collections.OrderedDict((name, {'hits': self.hits[name], 'misses': self.misses[name]})
+                                         for name in sorted(set(self.hits) | set(self.misses)))
+        return {'stages': collections.OrderedDict((stage, seconds) for (stage, seconds) in self.times.items()),
+                'requests': requests,
+                'caches': caches}
+
+    def save(self, path):
+        with open(path, 'w') as metrics:
+            json.dump(self.summary(), metrics, indent=2)
+
+    def report(self):
+        summary = self.summary()
+        stage_rows = [[stage, '%.3f' % seconds] for (stage, seconds) in summary['stages'].items() if seconds]
+        # Extraction runs in download workers, its time is summed over all of them
+        report = [tabulate.tabulate(stage_rows, ['stage', 'seconds'])] if stage_rows else []
+
+        request_rows = [[endpoint, r['count'], '%.0f' % r['p50_ms'], '%.0f' % r['p95_ms'], '%.0f' % r['p99_ms'],
+                         self.format_size(r['bytes']), r['retries'], r['errors']]
+                        for (endpoint, r) in summary['requests'].items()]
+        if request_rows:
+            report.append(tabulate.tabulate(request_rows, ['requests', 'count', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                           'received', 'retries', 'errors']))
+
+        cache_rows = [[name, c['hits'], c['misses'], '%.0f%%' % (100.0 * c['hits'] / (c['hits'] + c['misses']))]
+                      for (name, c) in summary['caches'].items()]
+        if cache_rows:
+            report.append(tabulate.tabulate(cache_rows, ['cache', 'hits', 'misses', 'hit rate']))
+        return '\n\n'.join(report)
+
+    @staticmethod
+    def format_size(size):
+        for unit in ('B', 'KB', 'MB'):
+            if size < 1024:
+                return '%.0f %s' % (size, unit)
+            size /= 1024.0
+        return '%.1f GB' % size
+
+    def start_profile(self, path):
+        # Main thread is profiled from now on, download workers while running profiled() calls
+        self.profile_path = path
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        self.thread_profile.profile = profile
+        profile.enable()
+        atexit.register(self.save_profile)
+
+    def profiled(self, function):
+        if self.profile_path is None:
+            return function
+
+        def run(*args, **kwargs):
+            profile = getattr(self.thread_profile, 'profile', None)
+            if profile is self.profiles[0]:
+                # Main thread is already profiled
+                return function(*args, **kwargs)
+            if profile is None:
+                profile = self.thread_profile.profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows only one profiler, the main one which profiles all threads
+                return function(*args, **kwargs)
+            if profile not in self.profiles:
+                with self.metrics_lock:
+                    self.profiles.append(profile)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+        return run
+
+    def save_profile(self):
+        self.profiles[0].disable()
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.profile_path)
+        with open(self.profile_path + '.txt', 'w') as report:
+            stats.stream = report
+            stats.sort_stats('cumulative').print_stats(50)
+        self.logger.info('Saved profile into %s, summary into %s.txt' % (self.profile_path, self.profile_path))
@@ -1,45 +1,368 @@
 from src.config import Config
 from datetime import datetime
 from src.log import RiaLogger
+from src.stats import ResultStats
+import collections
+import json
 import os
-import statistics
+import shutil
+import sqlite3
+import sys
 import tabulate
+import threading
 import unicodecsv as csv
 
+pyarrow = None
+
+
+def import_pyarrow():
+    # Imported only for "parquet" output, it takes a noticeable part of the CLI start up
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return None
+        pyarrow = sys.modules['pyarrow']
+    return pyarrow
+
+
+class CsvStream:
+
+    def __init__(self, path, header, offset=None):
+        if offset is None:
+            self.file = open(path, 'wb')
+            self.file.write(u'\ufeff'.encode('utf8'))
+            self.writer = csv.DictWriter(self.file, header, restval='-')
+            self.writer.writeheader()
+        else:
+            # Continue interrupted file, dropping rows written after the given offset
+            self.file = open(path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            self.writer = csv.DictWriter(self.file, header, restval='-')
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class NdjsonStream:
+
+    def __init__(self, path, header, offset=None):
+        self.file = sys.stdout
+
+    def write(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        return None
+
+    def close(self):
+        self.file.flush()
+
+
+class TypedStream:
+    integer_columns = ('id', 'year', 'mileage', 'price(uah)', 'price(usd)', 'price(eur)')
+    float_columns = ('displacement',)
+    timestamp_columns = ('created', 'updated', 'sold')
+    category_columns = ('status', 'fuel', 'gearbox', 'city', 'region', 'type', 'exchange')
+    timestamp_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, header):
+        self.header = list(header)
+        self.converters = [self.column_converter(column) for column in self.header]
+
+    def column_converter(self, column):
+        if column in self.integer_columns:
+            return int
+        if column in self.float_columns:
+            return float
+        if column in self.timestamp_columns:
+            return lambda value: datetime.strptime(value, self.timestamp_format)
+        return str
+
+    def typed_row(self, row):
+        values = []
+        for column, converter in zip(self.header, self.converters):
+            value = row.get(column, '-')
+            # '-' and empty values are stored as nulls
+            if value in ('-', '', None):
+                values.append(None)
+                continue
+            try:
+                values.append(converter(value))
+            except (TypeError, ValueError):
+                values.append(None)
+        return values
+
+
+class ParquetStream(TypedStream):
+
+    def __init__(self, path, header, offset=None):
+        super(ParquetStream, self).__init__(header)
+        import_pyarrow()
+        self.row_group = int(Config.shared().read_config('RIA_CONFIG', 'parquet_row_group'))
+        self.schema = pyarrow.schema([(column, self.column_type(column)) for column in self.header])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+        self.columns = [[] for column in self.header]
+
+    def column_type(self, column):
+        if column in self.integer_columns:
+            return pyarrow.int64()
+        if column in self.float_columns:
+            return pyarrow.float64()
+        if column in self.timestamp_columns:
+            return pyarrow.timestamp('s')
+        if column in self.category_columns:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        return pyarrow.string()
+
+    def write(self, row):
+        for values, value in zip(self.columns, self.typed_row(row)):
+            values.append(value)
+
+    def write_row_group(self):
+        if self.columns[0]:
+            arrays = [self.column_array(field.type, values) for field, values in zip(self.schema, self.columns)]
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.columns = [[] for column in self.header]
+
+    @staticmethod
+    def column_array(column_type, values):
+        # Categorical columns are dictionary-encoded
+        if pyarrow.types.is_dictionary(column_type):
+            return pyarrow.array(values, type=column_type.value_type).dictionary_encode()
+        return pyarrow.array(values, type=column_type)
+
+    def flush(self):
+        # Parquet is written in row groups, not row by row
+        if len(self.columns[0]) >= self.row_group:
+            self.write_row_group()
+        return None
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+
+
+class SqliteStream(TypedStream):
+    table = 'listings'
+    index_columns = (('make', 'model', 'year'), ('price(usd)',))
+
+    def __init__(self, path, header, offset=None, make='', model=''):
+        super(SqliteStream, self).__init__(header)
+        if 'id' not in self.header:
+            RiaLogger.log('"sqlite" output needs "id" in [OUTPUT] fields', 'error')
+            sys.exit(2)
+        self.make = make
+        self.model = model
+        self.seen = datetime.now().strftime(self.timestamp_format)
+        self.rows = []
+        # Concurrent batch searches write the same database
+        self.db = sqlite3.connect(path, timeout=60)
+        self.create_table()
+        columns = self.header + ['make', 'model', 'first_seen', 'last_seen']
+        # Update existing cars, keep known values for columns missing in the new row
+        updates = ['%s = COALESCE(excluded.%s, %s)' % (self.quote(c), self.quote(c), self.quote(c))
+                   for c in columns if c not in ('id', 'first_seen')]
+        self.upsert = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT(id) DO UPDATE SET %s' % (
+            self.table, ', '.join(map(self.quote, columns)), ', '.join('?' * len(columns)), ', '.join(updates))
+
+    @staticmethod
+    def quote(column):
+        return '"%s"' % column
+
+    def column_converter(self, column):
+        # SQLite keeps dates as text
+        if column in self.timestamp_columns:
+            return str
+        return super(SqliteStream, self).column_converter(column)
+
+    def column_type(self, column):
+        if column in self.integer_columns:
+            return 'INTEGER'
+        if column in self.float_columns:
+            return 'REAL'
+        return 'TEXT'
+
+    def create_table(self):
+        self.db.execute('CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY)' % self.table)
+        existing = set(row[1] for row in self.db.execute('PRAGMA table_info(%s)' % self.table))
+        for column in self.header + ['make', 'model', 'first_seen', 'last_seen']:
+            if column not in existing:
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (self.table, self.quote(column),
+                                                                    self.column_type(column)))
+        for columns in self.index_columns:
+            name = 'idx_%s_%s' % (self.table, '_'.join(c.replace('(', '_').replace(')', '') for c in columns))
+            self.db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, self.table,
+                                                                          ', '.join(map(self.quote, columns))))
+        self.db.commit()
+
+    def write(self, row):
+        self.rows.append(self.typed_row(row) + [self.make, self.model, self.seen, self.seen])
+
+    def flush(self):
+        # One transaction per batch of rows
+        if self.rows:
+            with self.db:
+                self.db.executemany(self.upsert, self.rows)
+            self.rows = []
+        return None
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def discard(self):
+        self.rows = []
+        self.db.close()
+
 
 class Output:
     def __init__(self):
-        self.config = Config()
+        self.config = Config.shared()
         self.time = datetime.now().strftime("%Y%m%d%H%M%S")
         self.path = None
         self.format = self.config.read_config('RIA_CONFIG', 'output_format')
         self.location = self.config.read_config('RIA_CONFIG', 'search_results_location')
+        self.flush_rows = int(self.config.read_config('RIA_CONFIG', 'output_flush_rows'))
+        self.database = self.config.read_config('RIA_CONFIG', 'results_database')
+        self.name = None
+        # Distinguishes outputs of batch searches started at the same time
+        self.label = None
+        self.part_path = None
+        self.stream = None
+        self.rows = None
+        self.header = None
+        self.count = 0
+        # Called with rows count and file size after each flush
+        self.on_flush = None
 
-    def set_path(self, make, model, count, with_warning):
+    def set_path(self, make, model, count, with_warning, kind=None):
         sep = '_'
         is_failed = ''
         if with_warning:
-            is_failed = '_'
+            is_failed = '_FAILED'
+        if self.label:
+            model = model+sep+self.label
+        if kind:
+            model = model+sep+kind
         path = os.path.join(self.location, make+model+sep+str(count)+sep+self.time+is_failed+'.'+self.format)
         path.replace(' ', '')
         self.path = path
 
     @staticmethod
     def get_best(adverts):
-        price_deviation = 0.1
+        stats = ResultStats()
+        stats.year_column, stats.price_column = 'autoData_year', 'USD'
+        for a in adverts:
+            stats.add(a.info)
+        return [adverts[i] for i in stats.best()]
+
+    def open(self, header, make, model, kind=None, count=0, offset=None):
+        # Rows are written as they come into a '.part' file, renamed on close once the count is known
+        self.name = (make, model, kind)
+        self.header = header
+        self.count = count
+        if self.format == 'sqlite':
+            if not os.path.isdir(self.location):
+                os.mkdir(self.location)
+            self.path = os.path.join(self.location, self.database)
+            self.stream = SqliteStream(self.path, header, offset, make, model)
+        elif self.format in self.streams:
+            if not os.path.isdir(self.location):
+                os.mkdir(self.location)
+            if self.label:
+                model = '%s_%s' % (model, self.label)
+            self.part_path = os.path.join(self.location, '%s%s_%s.%s.part' % (make, model, self.time, self.format))
+            self.stream = self.streams[self.format](self.part_path, header, offset)
+        else:
+            self.rows = []
+
+    @property
+    def resumable(self):
+        return self.format == 'csv'
+
+    def writerow(self, row):
+        self.count += 1
+        if self.stream:
+            self.stream.write(row)
+            if self.count % self.flush_rows == 0:
+                self.flush()
+        else:
+            self.rows.append(row)
 
-        year = statistics.mode([a.info['autoData_year'] for a in adverts])
-        price = statistics.median([a.info['USD'] for a in adverts if a.info['autoData_year'] == year])
-        price_low_lim = price - price * price_deviation
-        price_high_lim = price + price * price_deviation
+    def flush(self):
+        if self.stream:
+            offset = self.stream.flush()
+            if self.on_flush:
+                self.on_flush(self.count, offset)
+
+    def close(self, with_warning):
+        make, model, kind = self.name
+        if self.format == 'sqlite':
+            self.stream.close()
+            self.stream = None
+            RiaLogger.log("Saved %s cars into %s" % (self.count, self.path))
+            return
+        self.set_path(make, model, self.count, with_warning, kind)
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+            if self.format == 'ndjson':
+                return
+            os.replace(self.part_path, self.path)
+            RiaLogger.log("Saved search results into %s" % self.path)
+        else:
+            self.write(self.rows, self.header)
+            self.rows = None
+
+    def save_copy(self, with_warning):
+        # Copy of rows written so far, '.part' file is kept to be continued
+        make, model, kind = self.name
+        self.set_path(make, model, self.count, with_warning, kind)
+        shutil.copyfile(self.part_path, self.path)
+        RiaLogger.log("Saved search results into %s" % self.path)
 
-        best = [a for a in adverts if price_high_lim >= a.info['USD'] >= price_low_lim]
-        return best
+    def discard(self):
+        if self.format == 'sqlite':
+            self.stream.discard()
+            self.stream = None
+        elif self.stream:
+            self.stream.close()
+            self.stream = None
+            if self.format != 'ndjson':
+                os.remove(self.part_path)
+        self.rows = None
 
-    def write(self, data):
+    def write(self, data, header=None):
         if not os.path.isdir(self.location):
             os.mkdir(self.location)
-        header = data[0].keys()
+        if header is None:
+            header = data[0].keys()
+        if self.format == 'sqlite':
+            stream = SqliteStream(os.path.join(self.location, self.database), header)
+            for row in data:
+                stream.write(row)
+            stream.close()
+            RiaLogger.log("Saved %s cars into %s" % (len(data), os.path.join(self.location, self.database)))
+            return
+        if self.format in ('ndjson', 'parquet'):
+            stream = self.streams[self.format](self.path, header)
+            for row in data:
+                stream.write(row)
+            stream.close()
+            if self.format == 'parquet':
+                RiaLogger.log("Saved search results into %s" % self.path)
+            return
         if self.format == 'txt':
             rows = [x.values() for x in data]
             with open(self.path, 'wb') as output_file:
@@ -52,13 +375,49 @@ class Output:
                 dict_writer.writerows(data)
         RiaLogger.log("Saved search results into %s" % self.path)
 
+    def check_format(self):
+        if self.format == 'parquet' and import_pyarrow() is None:
+            RiaLogger.log('"parquet" output requires pyarrow, install it with "pip3 install pyarrow"', 'error')
+            sys.exit(2)
+
+    streams = {
+        'csv': CsvStream,
+        'ndjson': NdjsonStream,
+        'parquet': ParquetStream
+    }
+
+
+class BatchOutput:
+    # Cars of one batch search written into the output shared by all of them, opened and closed by the batch
+    lock = threading.Lock()
+
+    def __init__(self, output, header, query):
+        self.output = output
+        self.header = header
+        self.query = query
+        self.format = output.format
+        self.time = output.time
+        self.resumable = False
+        self.on_flush = None
+
+    def check_format(self):
+        self.output.check_format()
+
+    def open(self, header, make, model, kind=None, count=0, offset=None):
+        pass
 
-#stats
+    def writerow(self, row):
+        row = collections.OrderedDict((column, row.get(column, '-')) for column in self.header)
+        row['query'] = self.query
+        with self.lock:
+            self.output.writerow(row)
 
+    def flush(self):
+        with self.lock:
+            self.output.flush()
 
-# - lowest price
-# - oldest year average price range
-# - average year range average price range
-# - newest year average price range
-# - average year range average mileage range
+    def close(self, with_warning):
+        pass
 
+    def discard(self):
+        pass
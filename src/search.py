@@ -1,23 +1,39 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
+from src.archive import ResponseArchive
 from src.config import Config
+from datetime import datetime
+from src.details import DetailCache
+from src.extract import ExtractionPlan
 from flatten_json import flatten
+import hashlib
 import json
-from src.log import RiaLogger
+from src.limiter import RateLimiter
+from src.log import LazyJson, RiaLogger
+from src.metrics import RunMetrics
+from src.session import RiaSession
+from src.stats import ResultStats
 import logging
 import requests
 import sys
+import threading
 import time
 from tqdm import tqdm
 
 
 class Search(object):
     logger = logging.getLogger("ria.run")
+    ria_dev_url = 'https://developers.ria.com'
+    ria_url = 'https://auto.ria.com'
 
     def __init__(self):
-        self.config = Config()
-        self.parameters = {'api_key': self.config.get_api_key()}
-        self.ria_dev_url = 'https://developers.ria.com'
-        self.ria_url = 'https://auto.ria.com'
+        self.config = Config.shared()
+        self.ria_dev_url = self.config.read_config('RIA_CONFIG', 'api_url').rstrip('/')
+        self.parameters = {'api_key': self.config.api_key}
+        self.session = RiaSession.shared(self.config)
+        self.limiter = RateLimiter.shared(self.config)
+        self.metrics = RunMetrics.shared()
+        self.archive = ResponseArchive.shared(self.config)
         self.start_time = time.time()
         self.end_time = None
         self.run_time = None
@@ -29,27 +45,42 @@ class Search(object):
     def __setitem__(self, item, value):
         setattr(self, item, value)
 
-    def make_request(self, url, parameters):
-        self.logger.debug('Sending request to %s URL with the following parameters: %s' % (url,
-                                                                                           self.dump_json(parameters)))
+    def make_request(self, url, parameters, endpoint='default'):
+        # Parameters are copied as they change for following requests before the record is written
+        self.logger.debug('Sending request to %s URL with the following parameters: %s', url,
+                          LazyJson(dict(parameters)))
         try:
-            r = requests.get(url, params=parameters, timeout=10)
+            for attempt in range(self.limiter.max_retries + 1):
+                self.limiter.acquire()
+                start = time.perf_counter()
+                r = self.session.get(url, parameters, endpoint)
+                self.metrics.request(endpoint, time.perf_counter() - start, len(r.content))
+                # Back off and slow down when RIA rejects the request due to the token limit
+                if r.status_code in self.limited_codes and attempt < self.limiter.max_retries:
+                    self.metrics.retry(endpoint)
+                    delay = self.limiter.penalize(attempt, r.headers.get('Retry-After'))
+                    RiaLogger.log('RIA responded %s, retrying in %s seconds' % (r.status_code, delay), 'warn',
+                                  suppress_stdout=True)
+                    time.sleep(delay)
+                    continue
+                break
             code = r.status_code
             if code != 200:
-                    print("ERROR response: %s" % code)
+                    self.metrics.error(endpoint)
+                    RiaLogger.echo("ERROR response: %s" % code)
                     decode = r.content.decode('utf8').replace("'", '"')
                     data = json.loads(decode)
                     message = data['error']
                     RiaLogger.log(message['code'] + ': ' + message['message'], 'error')
-                    if code == 403:
-                        exit(1)
                     return False
             else:
+                self.limiter.recover(r)
                 return r
         except json.decoder.JSONDecodeError as e:
             RiaLogger.log(e, 'error')
             return False
         except requests.exceptions.RequestException as e:
+            self.metrics.error(endpoint)
             RiaLogger.log(e, 'error')
             return False
 
@@ -60,6 +91,15 @@ class Search(object):
             self.logger.error('Failed to make "%s" request.' % request_name)
             exit(1)
 
+    def archive_search(self, parameters, ads_ria):
+        self.archive.add('search', {k: v for (k, v) in parameters.items() if k != 'api_key'}, ads_ria)
+
+    @staticmethod
+    def criteria_key(criteria):
+        # Short stable key of search criteria to name files kept between runs
+        criteria = {k: v for (k, v) in criteria.items() if k != 'page'}
+        return hashlib.sha1(json.dumps(criteria, sort_keys=True).encode('utf8')).hexdigest()[:16]
+
     @staticmethod
     def dump_json(j, indent=2, sep=(',', ':'), data_type=None):
         if data_type == 'list':
@@ -96,11 +136,12 @@ class Search(object):
             return True
 
         while True:
-            decision = input(message)
+            RiaLogger.echo(message, end='')
+            decision = input()
             if decision in answer_options:
                 break
             else:
-                print("\nPlease input %s" % str(answer_options))
+                RiaLogger.echo("\nPlease input %s" % str(answer_options))
 
         if decision in negative:
             return False
@@ -135,14 +176,35 @@ class Search(object):
     @staticmethod
     def print_out(l, message=None):
         if message:
-            print(message)
+            RiaLogger.echo(message)
         for e in l:
-            print("'" + e + "'"),
+            RiaLogger.echo("'" + e + "'")
 
     aux = [
-        'average-price'
+        'average-price',
+        'budget',
+        'reprocess',
+        'warm-cache'
     ]
 
+    limited_codes = (403, 429)
+
+    # Lowest production year used to split large searches by years
+    first_year = 1900
+
+    # Catalogs needed to validate and convert search options
+    catalog_options = collections.OrderedDict(
+        [
+            ('marka_id', 'makes'),
+            ('bodystyle', 'styles'),
+            ('gearbox', 'gearboxes'),
+            ('type', 'fuel_types'),
+            ('color', 'colors'),
+            ('brandOrigin', 'countries'),
+            ('auto_options', 'options')
+        ]
+    )
+
     status = {
         'all': 0,
         'sold': 1,
@@ -181,29 +243,30 @@ class Search(object):
 
 
 class Advertisement(Search):
+    refresh_lock = threading.Lock()
+    refresher = None
+    # Catalogs being fetched again in background by cache name and suffix
+    refreshes = {}
 
     def __init__(self, category=1):
         super(Advertisement, self).__init__()
         self.category_id = category
         self.opts = None
         self.make_name = None
-        self.makes = self.all('makes')
-        self.make_names = self.extract_key_names(self.makes)
+        self.catalogs = {}
         self.make_id = None
         self.model_name = ''
         self.models = None
         self.model_names = None
         self.model_id = None
-        self.gearboxes = self.squeeze(self.all('gearboxes'))
-        self.options = self.squeeze(self.all('options'))
-        self.bodies = self.squeeze(self.all('styles'))
-        self.fuel_type = self.squeeze(self.all('fuel_types'))
-        self.colors = self.squeeze(self.all('colors'))
-        self.countries = self.squeeze(self.all('countries'))
         self.countpage = 100
+        self.page_workers = int(self.config.read_config('RIA_CONFIG', 'page_workers'))
+        self.partition_threshold = int(self.config.read_config('RIA_CONFIG', 'partition_threshold'))
+        self.catalog_max_age = int(self.config.read_config('RIA_CONFIG', 'catalog_max_age'))
         self.page = 0
         self.criteria = None
-        self.opts_to_remove = ['get', 'verbose']
+        self.opts_to_remove = ['get', 'verbose', 'workers', 'quiet', 'output', 'delta', 'resume', 'stats', 'local',
+                               'profile', 'metrics', 'batch', 'combined']
         self.warn = False
 
     def set_avg_price_criteria(self, options):
@@ -220,7 +283,54 @@ class Advertisement(Search):
             apc['fuel_id'] = self.fuel_type[options['type']]
         self.criteria = apc
 
-    def all(self, spec):
+    @property
+    def makes(self):
+        return self.catalog('makes')
+
+    @property
+    def make_names(self):
+        return self.extract_key_names(self.makes)
+
+    @property
+    def gearboxes(self):
+        return self.squeeze(self.catalog('gearboxes'))
+
+    @property
+    def options(self):
+        return self.squeeze(self.catalog('options'))
+
+    @property
+    def bodies(self):
+        return self.squeeze(self.catalog('styles'))
+
+    @property
+    def fuel_type(self):
+        return self.squeeze(self.catalog('fuel_types'))
+
+    @property
+    def colors(self):
+        return self.squeeze(self.catalog('colors'))
+
+    @property
+    def countries(self):
+        return self.squeeze(self.catalog('countries'))
+
+    def catalog(self, spec):
+        if spec not in self.catalogs:
+            self.load_catalogs([spec])
+        return self.catalogs[spec]
+
+    def load_catalogs(self, specs):
+        missing = [spec for spec in collections.OrderedDict.fromkeys(specs) if spec not in self.catalogs]
+        if len(missing) > 1:
+            # Fetch several catalogs at once, cold cache means one request per catalog
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                loaded = list(executor.map(self.all, missing))
+        else:
+            loaded = [self.all(spec) for spec in missing]
+        self.catalogs.update(zip(missing, loaded))
+
+    def catalog_url(self, spec):
         ria = self.ria_dev_url + '/auto'
         endpoint = {
             'makes': ria + '/categories/1/marks',
@@ -231,39 +341,100 @@ class Advertisement(Search):
             'colors': ria + '/colors',
             'countries': ria + '/countries'
         }
-        self.logger.debug("Checking available %s to search" % spec)
+        return endpoint[spec]
 
-        if self.config.cache_valid(spec):
-            return self.config.get_cache_data(spec)
-        else:
-            r = self.make_request(endpoint[spec], self.parameters)
-            super(Advertisement, self).check_response('get all %s' % spec, r)
-            car_spec = r.json()
-            self.config.store_cache_data(car_spec, spec)
-            return car_spec
+    def models_url(self, make_id):
+        return "%s/auto/categories/1/marks/%s/models" % (self.ria_dev_url, make_id)
+
+    def all(self, spec):
+        self.logger.debug("Checking available %s to search" % spec)
+        return self.cached_catalog('get all %s' % spec, self.catalog_url(spec), spec)
 
     def all_models(self):
-        url = "%s/auto/categories/1/marks/%s/models" % (self.ria_dev_url, self.make_id)
         self.logger.debug("Checking available '%s' models" % self.make_name)
-        if self.config.cache_valid('models', self.make_id):
-            models = self.config.get_cache_data('models', self.make_id)
-        else:
-            r = self.make_request(url, self.parameters)
-            self.check_response('get all models', r)
-            models = r.json()
-            self.config.store_cache_data(models, 'models', self.make_id)
-        self.logger.debug("Ria '%s' models: %s" % (self.make_name, self.dump_json(self.log_order_squeeze(models))))
+        models = self.cached_catalog('get all models', self.models_url(self.make_id), 'models', self.make_id)
+        self.logger.debug("Ria '%s' models: %s", self.make_name, LazyJson(self.log_order_squeeze(models)))
         return models
 
-    def average_price(self):
+    def cached_catalog(self, request_name, url, name, suffix=None):
+        # Catalogs rarely change, expired ones younger than catalog_max_age are used as they are while
+        # fetched again in background
+        valid = self.config.cache_valid(name, suffix)
+        age = None if valid else self.config.cache.age(name, suffix or '')
+        stale = age is not None and age < self.catalog_max_age
+        self.metrics.cache('catalogs', valid or stale)
+        if valid:
+            return self.config.get_cache_data(name, suffix)
+        if stale:
+            self.logger.debug('Using "%s" cache data %s expired %s seconds ago until it is refreshed' % (
+                name, suffix or '', round(age - self.config.cache.ttl(name), 2)))
+            self.refresh(url, name, suffix)
+            return self.config.get_cache_data(name, suffix)
+        r = self.make_request(url, self.parameters, 'catalog')
+        self.check_response(request_name, r)
+        data = r.json()
+        self.config.store_cache_data(data, name, suffix)
+        return data
+
+    def refresh(self, url, name, suffix=None):
+        # One background fetch per catalog at a time, it completes before the script exits
+        with self.refresh_lock:
+            if (name, suffix) not in self.refreshes:
+                if Advertisement.refresher is None:
+                    Advertisement.refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix='refresh')
+                self.refreshes[(name, suffix)] = self.refresher.submit(self.refetch, url, name, suffix)
+            return self.refreshes[(name, suffix)]
+
+    def refetch(self, url, name, suffix):
+        try:
+            # Own parameters, searches update the shared ones meanwhile
+            r = self.make_request(url, {'api_key': self.config.api_key}, 'catalog')
+            if r:
+                self.config.store_cache_data(r.json(), name, suffix)
+                return True
+            RiaLogger.log('Failed to refresh "%s" cache data %s, keeping the cached one' % (name, suffix or ''),
+                          'warn', suppress_stdout=True)
+        except (requests.RequestException, ValueError) as e:
+            RiaLogger.log('Failed to refresh "%s" cache data %s: %s' % (name, suffix or '', e), 'warn',
+                          suppress_stdout=True)
+        finally:
+            with self.refresh_lock:
+                self.refreshes.pop((name, suffix), None)
+        return False
+
+    def warm_cache(self):
+        # All catalogs and models of the given make fetched again at once, returns number of refreshed ones
+        refreshes = [self.refresh(self.catalog_url(spec), spec) for spec in
+                     collections.OrderedDict.fromkeys(self.catalog_options.values())]
+        if self.make_id:
+            refreshes.append(self.refresh(self.models_url(self.make_id), 'models', self.make_id))
+        return sum(1 for refresh in refreshes if refresh.result())
+
+    def average_price(self, local=False):
+        if local:
+            # Cars downloaded by previous searches, RIA is asked only if there are too few recent ones
+            max_age = int(self.config.read_config('RIA_CONFIG', 'average_price_max_age'))
+            min_cars = int(self.config.read_config('RIA_CONFIG', 'average_price_min_cars'))
+            prices = DetailCache.shared(self.config).prices(self.criteria, max_age)
+            if prices and len(prices) >= min_cars:
+                self.logger.debug("Average price of %s downloaded cars" % len(prices))
+                self.print_average_price(ResultStats.average_price(prices))
+                return
+            self.logger.info('%s cars downloaded within %s seconds match the criteria, asking RIA' % (
+                len(prices), max_age))
         url = "%s/auto/average_price" % self.ria_dev_url
         self.logger.debug("Checking average price")
         self.parameters.update(self.criteria)
-        r = self.make_request(url, self.parameters)
-        print("Total cars: %s" % r.json()['total'])
-        print("Arithmetic mean: %s" % r.json()['arithmeticMean'])
-        print("Inter quartile mean: %s" % r.json()['interQuartileMean'])
-        print("Percentiles: %s" % r.json()['percentiles'])
+        r = self.make_request(url, self.parameters, 'average_price')
+        if r:
+            self.print_average_price(r.json())
+
+    @staticmethod
+    def print_average_price(average_price):
+        print("Total cars: %s" % average_price['total'])
+        print("Arithmetic mean: %s" % average_price['arithmeticMean'])
+        print("Inter quartile mean: %s" % average_price['interQuartileMean'])
+        print("Percentiles: %s" % average_price['percentiles'])
 
     def get_car_make_id(self, make_name):
         make_id = [make['value'] for make in self.makes if make['name'] == make_name]
@@ -285,14 +456,16 @@ class Advertisement(Search):
                                 })
         self.parameters.update(self.criteria)
 
-        r = self.make_request(url, self.parameters)
+        with self.metrics.stage('pagination'):
+            r = self.make_request(url, self.parameters, 'search')
 
         # Exit if request unsuccessful
         if not r:
             exit('Request not successful')
         # Return ad ids
         ads_ria = r.json()
-        self.logger.debug("'%s' search result from page 1: %s" % (self.make_name, self.dump_json(ads_ria)))
+        self.archive_search(self.parameters, ads_ria)
+        self.logger.debug("'%s' search result from page 1: %s", self.make_name, LazyJson(ads_ria))
 
         # Check count of records returned
         adverts_total_count = ads_ria['result']['search_result']['count']
@@ -303,61 +476,151 @@ class Advertisement(Search):
 
         # Ask if user needs to continue the search
         if self.make_name and self.model_name:
-            print('Found %s matches for "%s %s" with given criteria' % (adverts_total_count, self.make_name, self.model_name))
+            RiaLogger.echo('Found %s matches for "%s %s" with given criteria' % (adverts_total_count, self.make_name,
+                                                                                 self.model_name))
         else:
-            print('Found %s matches for "%s" with given criteria' % (adverts_total_count, self.make_name))
+            RiaLogger.echo('Found %s matches for "%s" with given criteria' % (adverts_total_count, self.make_name))
 
         if not self.continue_search('Get? (y/n)'):
             self.logger.info('Search is cancelled by user')
             exit(0)
 
-        # Get ad ids
-        adverts_ids = ads_ria['result']['search_result']['ids']
-
-        if adverts_total_count > 100:
-            # Calculate number of pages
-            page_num = int(adverts_total_count / self.countpage)
-
-            if adverts_total_count % self.countpage == 0:
-                page_num -= 1
-
-            for ad in tqdm(range(page_num), desc='Searching cars on pages', unit='page'):
-                self.parameters['page'] = ad + 1
-
-                self.logger.debug("Searching cars on page %s" % (self.parameters['page'] + 1))
-                r = self.make_request(url, self.parameters)
-                ads_ria = r.json()
-                self.logger.debug("'%s %s' search result from page %s: %s" % (self.make_name,
-                                                                              self.model_name,
-                                                                              str(self.parameters['page'] + 1),
-                                                                              self.dump_json(ads_ria)))
-                adverts_ids_pages = ads_ria['result']['search_result']['ids']
+        # Get ad ids, a copy as the first page response is logged lazily
+        adverts_ids = list(ads_ria['result']['search_result']['ids'])
 
-                if adverts_ids_pages:
-                    adverts_ids += adverts_ids_pages
-                else:
-                    break
-            self.logger.debug("Got IDs for %s matching car(s)" % len(adverts_ids))
+        with self.metrics.stage('pagination'):
+            if self.partition_threshold and adverts_total_count > self.partition_threshold:
+                adverts_ids = self.partitioned_ads(url, adverts_total_count)
+            elif adverts_total_count > self.countpage:
+                for adverts_ids_pages in self.search_pages(url, self.page_jobs(self.parameters,
+                                                                               adverts_total_count)):
+                    if adverts_ids_pages:
+                        adverts_ids += adverts_ids_pages
+                self.logger.debug("Got IDs for %s matching car(s)" % len(adverts_ids))
 
         if adverts_total_count != len(adverts_ids):
             self.logger.warning('Advertisement ids count mismatch: found %s, got %s' % (adverts_total_count,
                                                                                         len(adverts_ids)))
-        self.logger.debug("advertisement ids: %s (%s)" % (self.dump_json(adverts_ids), len(adverts_ids)))
+        self.logger.debug("advertisement ids: %s (%s)", LazyJson(adverts_ids), len(adverts_ids))
         return adverts_ids
 
+    def partitioned_ads(self, url, adverts_total_count):
+        # Split large search into disjoint sub-queries by years, then body styles and fuel types
+        self.logger.info('Splitting search of %s cars into smaller queries' % adverts_total_count)
+        root = dict(self.parameters, page=0)
+        root.setdefault('s_yers', self.first_year)
+        root.setdefault('po_yers', datetime.now().year + 1)
+        partitions = []
+        pending = [((), root)]
+        while pending:
+            with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+                counted = list(executor.map(lambda query: self.search_first_page(url, query[1]), pending))
+            next_pending = []
+            for (key, parameters), (count, ids) in zip(pending, counted):
+                if count == 0:
+                    continue
+                sub_queries = self.split_query(parameters) if count > self.partition_threshold else []
+                if sub_queries:
+                    next_pending += [(key + (i,), q) for (i, q) in enumerate(sub_queries)]
+                else:
+                    partitions.append((key, parameters, count, ids))
+            pending = next_pending
+        partitions.sort(key=lambda partition: partition[0])
+
+        partitions_count = sum(partition[2] for partition in partitions)
+        if partitions_count != adverts_total_count:
+            self.logger.warning('Sub-queries found %s cars instead of %s' % (partitions_count, adverts_total_count))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Search split into %s queries: %s", len(partitions),
+                              LazyJson([dict(p[1], count=p[2]) for p in partitions]))
+
+        # Download remaining pages of all sub-queries at once
+        jobs = []
+        for (key, parameters, count, ids) in partitions:
+            jobs += self.page_jobs(parameters, count)
+        pages = iter(self.search_pages(url, jobs))
+
+        adverts_ids = []
+        for (key, parameters, count, ids) in partitions:
+            adverts_ids += ids or []
+            for job in self.page_jobs(parameters, count):
+                adverts_ids += next(pages) or []
+        # Same car might be found by several sub-queries
+        return list(collections.OrderedDict.fromkeys(adverts_ids))
+
+    def split_query(self, parameters):
+        if parameters['s_yers'] < parameters['po_yers']:
+            middle = (parameters['s_yers'] + parameters['po_yers']) // 2
+            return [dict(parameters, po_yers=middle), dict(parameters, s_yers=middle + 1)]
+        if 'bodystyle' not in parameters:
+            return [dict(parameters, bodystyle=v) for v in sorted(set(self.bodies.values()))]
+        if 'type' not in parameters:
+            return [dict(parameters, type=v) for v in sorted(set(self.fuel_type.values()))]
+        return []
+
+    def search_first_page(self, url, parameters):
+        r = self.make_request(url, parameters, 'search')
+        if not r:
+            exit('Request not successful')
+        ads_ria = r.json()
+        self.archive_search(parameters, ads_ria)
+        search_result = ads_ria['result']['search_result']
+        return search_result['count'], search_result['ids']
+
+    def page_jobs(self, parameters, count):
+        # Pages after the first one with number of ids expected on each of them
+        page_num = int(count / self.countpage)
+        if count % self.countpage == 0:
+            page_num -= 1
+        return [(parameters, page, min(self.countpage, count - page * self.countpage))
+                for page in range(1, page_num + 1)]
+
+    def search_pages(self, url, jobs):
+        # Fetch pages concurrently, ids are returned in page order
+        with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+            results = executor.map(lambda job: self.search_page(url, job[0], job[1]), jobs)
+            pages = list(tqdm(results, total=len(jobs), desc='Searching cars on pages', unit='page'))
+
+        # Every page but the last one should be full
+        short_pages = []
+        for (parameters, page, expected), ids in zip(jobs, pages):
+            if ids is None or len(ids) < expected:
+                short_pages.append(str(page + 1))
+        if short_pages:
+            self.logger.warning('Got fewer ids than expected on pages %s' % ', '.join(short_pages))
+        return pages
+
+    def search_page(self, url, parameters, page):
+        parameters = dict(parameters, page=page)
+        self.logger.debug("Searching cars on page %s" % (page + 1))
+        r = self.make_request(url, parameters, 'search')
+        if not r:
+            return None
+        ads_ria = r.json()
+        self.archive_search(parameters, ads_ria)
+        self.logger.debug("'%s %s' search result from page %s: %s", self.make_name, self.model_name, page + 1,
+                          LazyJson(ads_ria))
+        return ads_ria['result']['search_result']['ids']
+
     def model_is_valid(self, model_name):
         if model_name in self.model_names:
             return True
         else:
             error_message = "UNKNOWN MODEL '%s', '%s' MODELS AVAILABLE TO SEARCH: " % (model_name, self.make_name)
-            self.log_error_list(error_message, self.model_names, 0)
+            self.log_error_list(error_message, self.model_names, 2)
 
 
 class VehicleDetails(Search):
 
-    def __init__(self, ria_id, bodies):
+    def __init__(self, ria_id, bodies, plan=None):
         super(VehicleDetails, self).__init__()
         self.bodies = bodies
+        # Extraction plan is normally compiled once and shared by all cars of a search
+        if plan is None:
+            plan = self.compile_plan(self.config, bodies)
+        self.plan = plan
+        self.details_cache = DetailCache.shared(self.config)
+        self.cached = False
         self.start_time = None
         self.end_time = None
         self.id = ria_id
@@ -368,61 +631,47 @@ class VehicleDetails(Search):
 
     def get(self):
         self.start_time = time.time()
+        cached = self.details_cache.get(self.id, self.plan.fields)
+        if self.details_cache.enabled:
+            self.metrics.cache('details', cached is not None)
+        if cached is not None:
+            self.code = 200
+            self.cached = True
+            self.info = cached
+            self.logger.debug("'%s' details loaded from cache" % self.id)
+            with self.metrics.stage('extraction'):
+                self.csv = self.check_set(self.info)
+            self.end_time = time.time()
+            self.run_time = round(self.end_time - self.start_time, 3)
+            return
         url = "%s/auto/info/" % self.ria_dev_url
         self.parameters.update({'auto_id': self.id})
-        r = self.make_request(url, self.parameters)
+        r = self.make_request(url, self.parameters, 'info')
         if r:
             self.code = r.status_code
-            raw_info = r.json()
-            self.logger.debug("'%s' details: %s" % (self.id, self.dump_json(raw_info)))
-            self.info = flatten(raw_info)
-            self.logger.debug("'%s' flattened details: %s" % (self.id, self.dump_json(self.info)))
-            self.csv = self.check_set(self.info)
+            with self.metrics.stage('extraction'):
+                raw_info = r.json()
+                if self.config.read_config('RIA_CONFIG', 'extraction') == 'flatten':
+                    self.info = flatten(raw_info)
+                else:
+                    # Take only configured fields instead of flattening the whole document
+                    self.info = self.plan.select(raw_info)
+                listing = self.plan.listing(raw_info)
+                self.csv = self.check_set(self.info)
+            self.archive.add('info', self.id, raw_info)
+            # Payloads of every car are logged only if sampled
+            if RiaLogger.sampled():
+                self.logger.debug("'%s' details: %s", self.id, LazyJson(raw_info))
+                self.logger.debug("'%s' flattened details: %s", self.id, LazyJson(self.info))
+            self.details_cache.put(self.id, self.plan.fields, self.info, listing)
             self.end_time = time.time()
             self.run_time = round(self.end_time - self.start_time, 3)
         else:
             self.failed = True
 
+    @staticmethod
+    def compile_plan(config, bodies):
+        return ExtractionPlan(config.get_fields_to_extract(), config.convert_field, bodies, Search.ria_url)
+
     def check_set(self, ria_adv_flat):
-        src_set = {}
-        # Get desired fields
-        for src_el in self.config.get_fields_to_extract():
-            if src_el in ria_adv_flat:
-                src_val = ria_adv_flat[src_el]
-
-                # Multiply mileage value by 1000
-                if src_el == 'autoData_raceInt':
-                    src_val *= 1000
-
-                # Check if Fuel field contains engine volume info
-                if src_el == 'autoData_fuelName':
-                    if self.has_number(src_val):
-                        if self.has_comma(src_val):
-                            fuel_info = src_val.split(',')
-                            src_set['displacement'] = fuel_info[1].split()[0]
-                            src_val = fuel_info[0]
-                        else:
-                            src_set['displacement'] = src_val.split()[0]
-                            src_val = '-'
-                    else:
-                        src_set['displacement'] = '-'
-
-                # set body type from response
-                if src_el == 'autoData_bodyId':
-                    body_styles = self.bodies
-                    if src_val in body_styles.values():
-                        src_val = list({k: v for k, v in list(body_styles.items()) if v == src_val}.keys())[0]
-                    else:
-                        src_val = '-'
-
-                if src_el == 'linkToView':
-                    src_val = self.ria_url + src_val
-
-                if src_el == 'autoData_description':
-                    # dispose of new line in description
-                    src_val = src_val.replace('\r', '').replace('\n', '')
-
-                src_set[self.config.convert_field[src_el]] = src_val
-            else:
-                src_set[self.config.convert_field[src_el]] = '-'
-        return src_set
+        return self.plan.extract(ria_adv_flat)
@@ -0,0 +1,35 @@
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+
+
+class RiaSession:
+    logger = logging.getLogger("ria.run")
+    lock = threading.Lock()
+    instance = None
+
+    def __init__(self, config):
+        self.pool_size = int(config.read_config('RIA_CONFIG', 'pool_size'))
+        self.timeouts = {k: float(v) for (k, v) in config.read_config('TIMEOUTS').items()}
+        self.session = requests.Session()
+        # Keep up to 'pool_size' connections alive per host and wait for a free one instead of opening extra
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+        self.logger.debug("Opened HTTP session, pool size %s, timeouts %s" % (self.pool_size, self.timeouts))
+
+    @classmethod
+    def shared(cls, config):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(config)
+        return cls.instance
+
+    def timeout(self, endpoint):
+        return self.timeouts.get(endpoint, self.timeouts['default'])
+
+    def get(self, url, parameters, endpoint='default'):
+        return self.session.get(url, params=parameters, timeout=self.timeout(endpoint))
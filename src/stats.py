@@ -0,0 +1,154 @@
+import tabulate
+
+numpy = None
+
+
+def import_numpy():
+    # numpy is loaded by the first statistics computed, most runs do not need it
+    global numpy
+    if numpy is None:
+        import numpy
+    return numpy
+
+
+class ResultStats:
+    # Output columns used for statistics
+    year_column = 'year'
+    price_column = 'price(usd)'
+    mileage_column = 'mileage'
+    id_column = 'id'
+    # Percentiles given by RIA average price endpoint
+    price_percentiles = (1, 5, 25, 50, 75, 95, 99)
+
+    def __init__(self):
+        self.ids = []
+        self.years = []
+        self.prices = []
+        self.mileages = []
+
+    def add(self, row):
+        self.ids.append(row.get(self.id_column, '-'))
+        self.years.append(self.number(row.get(self.year_column)))
+        self.prices.append(self.number(row.get(self.price_column)))
+        self.mileages.append(self.number(row.get(self.mileage_column)))
+
+    @staticmethod
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return float('nan')
+
+    def arrays(self):
+        import_numpy()
+        years = numpy.array(self.years, dtype=float)
+        prices = numpy.array(self.prices, dtype=float)
+        mileages = numpy.array(self.mileages, dtype=float)
+        return years, prices, mileages
+
+    @staticmethod
+    def grouped_percentiles(groups, values, percentiles):
+        # Percentiles of values per group with linear interpolation, all groups at once
+        order = numpy.lexsort((values, groups))
+        groups, values = groups[order], values[order]
+        keys, starts, counts = numpy.unique(groups, return_index=True, return_counts=True)
+        result = []
+        for q in percentiles:
+            position = starts + (counts - 1) * q / 100.0
+            low = numpy.floor(position).astype(int)
+            high = numpy.ceil(position).astype(int)
+            result.append(values[low] + (values[high] - values[low]) * (position - low))
+        return keys, counts, result
+
+    @staticmethod
+    def align(keys, other_keys, values):
+        # Values of other groups placed by keys, NaN for groups missing there
+        aligned = numpy.full(len(keys), numpy.nan)
+        if len(other_keys):
+            index = numpy.minimum(numpy.searchsorted(other_keys, keys), len(other_keys) - 1)
+            found = other_keys[index] == keys
+            aligned[found] = values[index[found]]
+        return aligned
+
+    def compute(self):
+        years, prices, mileages = self.arrays()
+        priced = ~numpy.isnan(years) & ~numpy.isnan(prices)
+        keys, counts, (q1, median, q3) = self.grouped_percentiles(years[priced], prices[priced], (25, 50, 75))
+
+        # Prices outside of 1.5 IQR from quartiles of the same year are outliers
+        iqr = q3 - q1
+        low_band, high_band = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+        group = numpy.searchsorted(keys, years[priced])
+        outliers = numpy.zeros(len(prices), dtype=bool)
+        outliers[priced] = (prices[priced] < low_band[group]) | (prices[priced] > high_band[group])
+
+        driven = ~numpy.isnan(years) & ~numpy.isnan(mileages)
+        mileage_keys, _, (m1, m3) = self.grouped_percentiles(years[driven], mileages[driven], (25, 75))
+
+        return {
+            'years': keys,
+            'counts': counts,
+            'q1': q1,
+            'median': median,
+            'q3': q3,
+            'low_band': numpy.maximum(low_band, 0),
+            'high_band': high_band,
+            'mileage_q1': self.align(keys, mileage_keys, m1),
+            'mileage_q3': self.align(keys, mileage_keys, m3),
+            'outliers': outliers,
+            'year_outliers': numpy.bincount(group[outliers[priced]], minlength=len(keys)),
+            'lowest': int(numpy.nanargmin(prices)) if priced.any() else None,
+            'prices': prices
+        }
+
+    def best(self):
+        # Indexes of cars of the most common year priced within the middle half of that year prices
+        stats = self.compute()
+        if not len(stats['years']):
+            return []
+        common = numpy.argmax(stats['counts'])
+        years, prices, mileages = self.arrays()
+        best = (years == stats['years'][common]) & (prices >= stats['q1'][common]) & (prices <= stats['q3'][common])
+        return numpy.flatnonzero(best).tolist()
+
+    def report(self):
+        if not self.prices:
+            return 'No cars to get statistics for'
+        stats = self.compute()
+        if not len(stats['years']):
+            return 'No "%s" and "%s" values to get statistics for' % (self.year_column, self.price_column)
+        header = ['year', 'cars', 'price 25%', 'median', 'price 75%', 'usual price range', 'mileage 25-75%',
+                  'outliers']
+        rows = []
+        for i, year in enumerate(stats['years']):
+            rows.append([int(year), int(stats['counts'][i]), round(stats['q1'][i]), round(stats['median'][i]),
+                         round(stats['q3'][i]),
+                         '%d - %d' % (stats['low_band'][i], stats['high_band'][i]),
+                         self.format_range(stats['mileage_q1'][i], stats['mileage_q3'][i]),
+                         int(stats['year_outliers'][i])])
+        lowest = stats['lowest']
+        summary = 'Lowest price: %d (id %s), oldest year: %d, most common year: %d, newest year: %d' % (
+            stats['prices'][lowest], self.ids[lowest], stats['years'][0],
+            stats['years'][numpy.argmax(stats['counts'])], stats['years'][-1])
+        return tabulate.tabulate(rows, header) + '\n' + summary
+
+    @classmethod
+    def average_price(cls, prices):
+        # Same values as RIA average price endpoint gives
+        import_numpy()
+        prices = numpy.array(prices, dtype=float)
+        values = numpy.percentile(prices, cls.price_percentiles)
+        q1, q3 = numpy.percentile(prices, (25, 75))
+        middle = prices[(prices >= q1) & (prices <= q3)]
+        return {
+            'total': len(prices),
+            'arithmeticMean': round(float(prices.mean()), 2),
+            'interQuartileMean': round(float(middle.mean()), 2),
+            'percentiles': {'%.1f' % q: round(float(v), 2) for q, v in zip(cls.price_percentiles, values)}
+        }
+
+    @staticmethod
+    def format_range(low, high):
+        if numpy.isnan(low):
+            return '-'
+        return '%d - %d' % (low, high)
@@ -1,8 +1,57 @@
 #!/usr/bin/env python3
-from src.search import Search
+from benchmark.mock_api import MockRia
+from src.archive import ResponseArchive
+from src.cache import CacheStore
+from src.config import Config
+from src.delta import DeltaSearch
+from src.details import DetailCache
+from src.extract import ExtractionPlan
+from src.fetch import DetailRegistry
+from src.journal import RunJournal
+from src.limiter import RateLimiter
+import src.limiter as limiter_module
+from src.log import JsonFormatter, LazyJson
+from src.metrics import RunMetrics
+from src.output import BatchOutput, Output, SqliteStream, import_pyarrow
+from src.stats import ResultStats
+from flatten_json import flatten
+import numpy
+from src.search import Advertisement, Search
+from src.search import VehicleDetails
+import atexit
+import configparser
+from datetime import datetime
+import json
+import logging
 import unittest
 import os
+import shutil
+import sqlite3
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def setUpModule():
+    # Tests run in a scratch directory with their own config, key and caches
+    global scratch_dir, package_dir
+    package_dir = os.getcwd()
+    scratch_dir = tempfile.mkdtemp()
+    os.chdir(scratch_dir)
+    os.mkdir('config')
+    Config.store_api_key(os.path.join('config', 'key.pkl'), 'test')
+
+
+def tearDownModule():
+    # Shared components would write into the scratch directory at exit
+    if RateLimiter.instance is not None:
+        atexit.unregister(RateLimiter.instance.save_history)
+    if CacheStore.instance is not None:
+        CacheStore.instance.close()
+    os.chdir(package_dir)
+    shutil.rmtree(scratch_dir)
 
 
 class TestSearch(unittest.TestCase):
@@ -40,33 +89,545 @@ class TestSearch(unittest.TestCase):
         actual = self.search.sort_elements(data.items())
         self.assertEqual(expected, actual)
 
-    def test_get_all_makes(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-get', 'all-makes', '-v'])
-        self.assertTrue(actual)
+    def test_shared_config(self):
+        config = Config.shared()
+        self.assertIs(config, self.search.config)
+        self.assertIs(config, VehicleDetails(1, {}).config)
+        self.assertFalse(config.reload())
+        with self.assertRaises(TypeError):
+            config.read_config('RIA_CONFIG')['workers'] = '1'
+
+    def test_extraction_plan(self):
+        convert_field = Config.convert_field
+        fields = ['autoData_raceInt', 'autoData_fuelName', 'autoData_bodyId', 'linkToView', 'soldDate']
+        plan = ExtractionPlan(fields, convert_field, {'Sedan': 3, 'Hatchback': 2}, 'https://auto.ria.com')
+        data = [{'autoData_raceInt': 150, 'autoData_fuelName': 'Petrol, 1.6 l.', 'autoData_bodyId': 3,
+                 'linkToView': '/auto_1.html'},
+                {'autoData_raceInt': 2, 'autoData_fuelName': 'Electro', 'autoData_bodyId': 9,
+                 'linkToView': '/auto_2.html', 'soldDate': '2019-08-19'}]
+        expected = [{'mileage': 150000, 'displacement': '1.6', 'fuel': 'Petrol', 'type': 'Sedan',
+                     'url': 'https://auto.ria.com/auto_1.html', 'sold': '-'},
+                    {'mileage': 2000, 'displacement': '-', 'fuel': 'Electro', 'type': '-',
+                     'url': 'https://auto.ria.com/auto_2.html', 'sold': '2019-08-19'}]
+        actual = plan.extract_batch(data)
+        self.assertEqual(expected, actual)
+        self.assertEqual(list(expected[0].keys()), plan.columns)
+        self.assertEqual(plan.columns, list(actual[0].keys()))
+
+    def test_extraction_plan_select(self):
+        data = {'USD': 5000, 'autoData': {'raceInt': 150, 'fuelName': '', 'photos': [{'id': 7}]},
+                'stateData': {'regionName': 'Kyiv', 'name': 'Kyiv'}, 'soldDate': None, 'user_phone': {}}
+        fields = ['USD', 'autoData_raceInt', 'autoData_fuelName', 'autoData_photos_0_id', 'stateData_regionName',
+                  'soldDate', 'user_phone', 'autoData', 'title']
+        plan = ExtractionPlan([], Config.convert_field, {}, '')
+        plan.paths = tuple((f, tuple(f.split('_'))) for f in fields)
+        expected = {k: v for (k, v) in flatten(data).items() if k in fields}
+        self.assertEqual(expected, plan.select(data))
+
+    def test_output_stream(self):
+        output = Output()
+        output.format = 'csv'
+        output.location = self.tmp_dir
+        output.open(['id', 'title'], 'Ford', 'Focus')
+        output.writerow({'id': 1, 'title': 'Ford Focus'})
+        self.assertTrue(os.path.isfile(output.part_path))
+        output.writerow({'id': 2})
+        output.close(True)
+        self.to_remove.append(output.path)
+        self.assertFalse(os.path.isfile(output.part_path))
+        self.assertTrue(output.path.endswith('_FAILED.csv'))
+        with open(output.path, 'rb') as f:
+            self.assertEqual(u'\ufeffid,title\r\n1,Ford Focus\r\n2,-\r\n', f.read().decode('utf8'))
+
+    def test_sqlite_stream(self):
+        path = os.path.join(self.tmp_dir, 'results.sqlite')
+        self.to_remove.append(path)
+        stream = SqliteStream(path, ['id', 'title', 'price(usd)'], make='Ford', model='Focus')
+        stream.seen = '2019-08-01 10:00:00'
+        stream.write({'id': '1', 'title': 'Ford Focus', 'price(usd)': '5000'})
+        stream.write({'id': '2', 'title': 'Ford Focus', 'price(usd)': '-'})
+        stream.close()
+        # Next search adds a column, updates prices and keeps values it does not know
+        stream = SqliteStream(path, ['id', 'title', 'price(usd)', 'mileage'], make='Ford', model='Focus')
+        stream.seen = '2019-08-02 10:00:00'
+        stream.write({'id': '1', 'title': '-', 'price(usd)': '4500', 'mileage': '120'})
+        stream.close()
+        db = sqlite3.connect(path)
+        rows = db.execute('SELECT id, title, "price(usd)", mileage, make, model, first_seen, last_seen '
+                          'FROM listings ORDER BY id').fetchall()
+        indexes = [row[1] for row in db.execute('PRAGMA index_list(listings)')]
+        db.close()
+        self.assertEqual([(1, 'Ford Focus', 4500, 120, 'Ford', 'Focus', '2019-08-01 10:00:00', '2019-08-02 10:00:00'),
+                          (2, 'Ford Focus', None, None, 'Ford', 'Focus', '2019-08-01 10:00:00',
+                           '2019-08-01 10:00:00')], rows)
+        self.assertIn('idx_listings_make_model_year', indexes)
+        self.assertIn('idx_listings_price_usd', indexes)
+
+    def test_resume_output(self):
+        config, saved = self.temp_config(self.tmp_dir)
+        try:
+            journal = RunJournal(config, 'test')
+        finally:
+            config.sections = saved
+        output = Output()
+        output.format, output.location, output.flush_rows = 'csv', self.tmp_dir, 2
+        output.open(['id'], 'Ford', 'Focus')
+        journal.start({'marka_id': 24}, [1, 2, 3, 4], output.time, output.part_path, ['id'])
+        output.on_flush = journal.commit
+        for car in (1, 2, 3):
+            journal.advance()
+            output.writerow({'id': car})
+        # Interrupted after the third car reached the file but not the journal
+        output.stream.flush()
+        state = journal.load()
+        self.assertEqual(2, state['committed'])
+        self.assertEqual(['id'], state['header'])
+        resumed = Output()
+        resumed.format, resumed.location, resumed.time = 'csv', self.tmp_dir, state['time']
+        resumed.open(['id'], 'Ford', 'Focus', None, state['count'], state['offset'])
+        for car in state['ids'][state['committed']:]:
+            resumed.writerow({'id': car})
+        resumed.close(False)
+        journal.finish()
+        self.to_remove.append(resumed.path)
+        self.assertTrue(resumed.path.endswith('_4_%s.csv' % state['time']))
+        with open(resumed.path, 'rb') as f:
+            self.assertEqual(u'\ufeffid\r\n1\r\n2\r\n3\r\n4\r\n', f.read().decode('utf8'))
+
+    @unittest.skipIf(import_pyarrow() is None, 'needs pyarrow')
+    def test_parquet_output(self):
+        pyarrow = import_pyarrow()
+        output = Output()
+        output.format = 'parquet'
+        output.location = self.tmp_dir
+        output.open(['id', 'price(usd)', 'displacement', 'fuel', 'created', 'title'], 'Ford', 'Focus')
+        output.writerow({'id': '1', 'price(usd)': '5000', 'displacement': '1.6', 'fuel': 'Бензин',
+                         'created': '2019-08-01 10:00:00', 'title': 'Ford Focus'})
+        output.writerow({'id': '2', 'price(usd)': '-', 'displacement': 'n/a', 'fuel': 'Бензин', 'created': '-'})
+        output.close(False)
+        self.to_remove.append(output.path)
+        table = pyarrow.parquet.read_table(output.path)
+        types = table.schema.types
+        self.assertEqual([pyarrow.int64(), pyarrow.int64(), pyarrow.float64(),
+                          pyarrow.dictionary(pyarrow.int32(), pyarrow.string())], types[:4])
+        # Parquet has no seconds unit, timestamps are read back in milliseconds
+        self.assertTrue(pyarrow.types.is_timestamp(types[4]))
+        self.assertEqual(pyarrow.string(), types[5])
+        rows = table.to_pylist()
+        self.assertEqual([5000, None], [row['price(usd)'] for row in rows])
+        self.assertEqual([1.6, None], [row['displacement'] for row in rows])
+        self.assertEqual(['Бензин', 'Бензин'], [row['fuel'] for row in rows])
+        self.assertEqual([datetime(2019, 8, 1, 10), None], [row['created'] for row in rows])
+        self.assertEqual(['Ford Focus', None], [row['title'] for row in rows])
+
+    def test_batch_output(self):
+        output = Output()
+        output.format = 'txt'
+        header = ['query', 'status', 'id']
+        output.open(header, 'Batch', '', 'combined')
+        BatchOutput(output, header, '-m Ford').writerow({'id': 1})
+        BatchOutput(output, header, '-m Ford -D').writerow({'status': 'added', 'id': 2})
+        self.assertEqual([['-m Ford', '-', 1], ['-m Ford -D', 'added', 2]],
+                         [list(row.values()) for row in output.rows])
+
+    def test_empty_buffered_output(self):
+        output = Output()
+        output.format = 'txt'
+        output.location = self.tmp_dir
+        output.open(['query', 'id'], 'Batch', '', 'combined')
+        output.close(False)
+        self.to_remove.append(output.path)
+        with open(output.path, 'rb') as f:
+            self.assertEqual(['query', 'id'], f.read().decode('utf8').split()[:2])
+
+    def test_detail_registry(self):
+        plan = ExtractionPlan(['autoData_autoId'], Config.convert_field, {}, '')
+        downloads = []
+
+        class Car:
+            def __init__(self):
+                self.id, self.plan = 1, plan
+                self.code, self.info, self.csv, self.cached, self.failed = None, None, None, False, False
+
+            def get(self):
+                downloads.append(self.id)
+                time.sleep(0.1)
+                self.code, self.csv = 200, {'id': 1}
+
+        registry = DetailRegistry()
+        cars = [Car() for i in range(3)]
+        threads = [threading.Thread(target=registry.fetch, args=(car,)) for car in cars]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Concurrent searches share one download, finished ones are not kept unless retained
+        self.assertEqual([1], downloads)
+        self.assertEqual([{'id': 1}] * 3, [car.csv for car in cars])
+        registry.fetch(Car())
+        self.assertEqual([1, 1], downloads)
+
+    def test_result_stats(self):
+        stats = ResultStats()
+        prices = {2001: [100, 200, 300, 400, 5000], 2002: [150, 250, 350]}
+        for year, year_prices in prices.items():
+            for price in year_prices:
+                stats.add({'year': year, 'price(usd)': price, 'mileage': '-'})
+        stats.add({'year': '-', 'price(usd)': 50})
+        actual = stats.compute()
+        self.assertEqual([2001, 2002], actual['years'].tolist())
+        self.assertEqual([5, 3], actual['counts'].tolist())
+        for i, year in enumerate(prices):
+            self.assertAlmostEqual(numpy.percentile(prices[year], 25), actual['q1'][i])
+            self.assertAlmostEqual(numpy.percentile(prices[year], 50), actual['median'][i])
+        self.assertEqual([4], numpy.flatnonzero(actual['outliers']).tolist())
+        self.assertEqual([1, 2, 3], stats.best())
+
+    def test_average_price(self):
+        actual = ResultStats.average_price([100, 200, 300, 400, 5000])
+        self.assertEqual(5, actual['total'])
+        self.assertEqual(1200, actual['arithmeticMean'])
+        self.assertEqual(300, actual['interQuartileMean'])
+        self.assertEqual(300, actual['percentiles']['50.0'])
+
+    def test_lazy_json(self):
+        items = LazyJson.items
+        LazyJson.items = 2
+        self.assertEqual('["1","2","... 1 more"]', str(LazyJson(['1', '2', '3'], None)))
+        LazyJson.items = items
+        record = logging.LogRecord('ria.run', logging.DEBUG, __file__, 0, "'%s' details: %s",
+                                   ('1', LazyJson({'USD': 100})), None)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(['1', {'USD': 100}], entry['args'])
+
+    def test_run_metrics(self):
+        metrics = RunMetrics()
+        for latency in (0.01, 0.02, 0.03):
+            metrics.request('info', latency, 2048)
+        metrics.retry('info')
+        metrics.cache('details', True)
+        metrics.cache('details', False)
+        with metrics.stage('output'):
+            pass
+        report = metrics.report()
+        self.assertIn('info', report)
+        self.assertIn('6 KB', report)
+        self.assertIn('50%', report)
+        self.assertEqual(['output'], [stage for (stage, seconds) in metrics.times.items() if seconds])
+
+    def test_response_archive(self):
+        archive = ResponseArchive(Config.shared())
+        archive.enabled, archive.location, archive.segment_rows = True, os.path.join(self.tmp_dir, 'archive'), 2
+        archive.add('info', 1, {'autoData': {'autoId': 1}, 'USD': 100, 'markId': 24})
+        archive.add('info', 2, {'autoData': {'autoId': 2}, 'USD': 200, 'markId': 9})
+        archive.add('info', 1, {'autoData': {'autoId': 1}, 'USD': 150, 'markId': 24})
+        archive.close()
+        paths = archive.segment_paths('info')
+        self.assertEqual(2, len(paths))
+        plan_args = (['autoData_autoId', 'USD'], Config.convert_field, {}, '')
+        rows = archive.reprocess(plan_args, 'paths', {'markId': 24}, 1)
+        self.assertEqual([{'id': 1, 'price(usd)': 150}], [dict(row) for row in rows])
+        shutil.rmtree(archive.location)
+
+    @staticmethod
+    def temp_config(location, **options):
+        # Shared config with options replaced while a component reads them
+        config = Config.shared()
+        sections = {'RIA_CONFIG': dict(config.read_config('RIA_CONFIG'), cache_files_location=location, **options),
+                    'CACHE_TTL': {'delta': '0'}}
+        config.sections, saved = sections, config.sections
+        return config, saved
+
+    def test_cache_store(self):
+        location = tempfile.mkdtemp()
+        config, saved = self.temp_config(location, cache_expiry_time='60', cache_size_limit='0.01')
+        try:
+            store = CacheStore(config)
+        finally:
+            config.sections = saved
+        store.put('catalog', 'marks', [1, 2])
+        store.put('delta', 'key', {3})
+        store.put('details', 1, 'x' * 6000)
+        self.assertEqual(0, store.ttl('delta'))
+        self.assertIsNone(store.get('catalog', 'marks', 1e-9))
+        self.assertEqual([1, 2], store.get('catalog', 'marks', store.ttl('catalog')))
+        # Least recently read entries are evicted once the store outgrows its limit, except never expiring ones
+        store.put('details', 2, 'x' * 6000)
+        self.assertEqual([1, 2], store.get('catalog', 'marks'))
+        self.assertEqual({3}, store.get('delta', 'key'))
+        self.assertIsNone(store.get('details', 1))
+        self.assertLessEqual(store.size, store.size_limit)
+        store.close()
+        shutil.rmtree(location)
+
+    def test_detail_cache(self):
+        location = tempfile.mkdtemp()
+        config, saved = self.temp_config(location, details_cache_expiry_time='60', average_price_max_age='3600')
+        store, config.store = config.store, CacheStore(config)
+        try:
+            cache = DetailCache(config)
+        finally:
+            config.sections = saved
+        cache.put(1, ['USD', 'title'], {'USD': 5000, 'title': 'Ford Focus', 'UAH': 1}, {'marka_id': 24, 'usd': 5000})
+        self.assertEqual({'USD': 5000, 'title': 'Ford Focus'}, cache.get(1, ['USD', 'title']))
+        self.assertIsNone(cache.get(2, ['USD', 'title']))
+        # Details stored for other fields are downloaded again
+        self.assertIsNone(cache.get(1, ['USD', 'title', 'UAH']))
+        cache.ttl = 1e-9
+        self.assertIsNone(cache.get(1, ['USD', 'title']))
+        self.assertEqual({'USD': 5000, 'title': 'Ford Focus'}, cache.get(1, ['USD', 'title'], fresh=False))
+        self.assertEqual([5000], cache.prices({'marka_id': 24}, 3600))
+        self.assertEqual([], cache.prices({'marka_id': 9}, 3600))
+        # Prices for local average price are kept with details cache disabled
+        cache.ttl = 0
+        cache.put(2, ['USD'], {'USD': 7000}, {'marka_id': 9, 'usd': 7000})
+        self.assertIsNone(cache.get(2, ['USD'], fresh=False))
+        self.assertEqual([7000], cache.prices({'marka_id': 9}, 3600))
+        config.store.close()
+        config.store = store
+        shutil.rmtree(location)
+
+    def test_delta_search(self):
+        self.temp_cache()
+        config = Config.shared()
+        delta = DeltaSearch(config, 'test')
+        # First search by given criteria finds only added cars
+        self.assertEqual(['1', '2', '3', '4'], delta.compare(['1', '2', '3', '4']))
+        self.assertEqual([], delta.removed)
+        delta.save(['1', '2', '3', '4'])
+        delta = DeltaSearch(config, 'test')
+        self.assertEqual(['6', '5'], delta.compare(['6', '3', '5', '1']))
+        self.assertEqual(['2', '4'], delta.removed)
+        # Removed cars get their last known details if cached, otherwise only the id
+        plan = ExtractionPlan(['autoData_autoId', 'USD'], Config.convert_field, {}, '')
+        DetailCache(config).put('2', plan.fields, {'autoData_autoId': 2, 'USD': 5000})
+        rows = delta.removed_rows(plan, DetailCache(config))
+        self.assertEqual([['removed', 2, 5000], ['removed', '4', '-']], [list(row.values()) for row in rows])
+        self.assertEqual(['status', 'id', 'price(usd)'], list(rows[1].keys()))
+
+    def test_rate_limiter_budget(self):
+        limiter = self.search.limiter
+        remaining = limiter.remaining()
+        limiter.acquire()
+        self.assertEqual(remaining - 1, limiter.remaining())
+        limiter.history.pop()
+
+    def test_rate_limiter_window(self):
+        class Clock:
+            now = 1000000.0
+
+            @classmethod
+            def time(cls):
+                return cls.now
+
+            @classmethod
+            def sleep(cls, seconds):
+                cls.now += seconds
+
+        class HourlyConfig:
+            @staticmethod
+            def read_config(section, param):
+                return {'requests_per_hour': '60', 'max_retries': '5'}[param]
+
+            @staticmethod
+            def get_cache_data(name):
+                return None
+
+            @staticmethod
+            def store_cache_data(data, name):
+                pass
+
+        saved = limiter_module.time
+        limiter_module.time = Clock
+        try:
+            limiter = RateLimiter(HourlyConfig())
+            start = Clock.now
+            sent = []
+            while Clock.now - start < 7200:
+                limiter.acquire()
+                sent.append(Clock.now)
+                if len(sent) == 60:
+                    self.assertEqual(0, limiter.remaining())
+        finally:
+            limiter_module.time = saved
+        # No hour long window holds more requests than the hourly budget
+        for i, t in enumerate(sent):
+            self.assertLessEqual(len([u for u in sent[i:] if u - t < 3600]), 60)
+        self.assertEqual(60, len([t for t in sent if t - start < 3600]))
+
+    def test_rate_limiter_backoff(self):
+        limiter = self.search.limiter
+        rate, tokens = limiter.rate, limiter.tokens
+        self.assertEqual(2, limiter.penalize(0))
+        self.assertEqual(7, limiter.penalize(1, '7'))
+        self.assertEqual(rate / 4, limiter.rate)
+        limiter.rate, limiter.tokens = rate, tokens
+
+    def test_partitioned_search(self):
+        mock = MockRia(300)
+        search = Advertisement()
+        search.ria_dev_url = mock.start()
+        search.countpage = 20
+        search.parameters['countpage'] = search.countpage
+        url = search.ria_dev_url + '/auto/search/'
+        expected = [str(car[0]) for car in mock.cars]
+        try:
+            search.partition_threshold = 50
+            ids = search.partitioned_ads(url, 300)
+            self.assertEqual(sorted(expected), sorted(ids))
+            # Cars found by overlapping sub-queries are kept once, in sub-query order
+            search.partition_threshold = 200
+            search.split_query = lambda parameters: [dict(parameters, po_yers=2012), dict(parameters, s_yers=2008)]
+            ids = search.partitioned_ads(url, 300)
+        finally:
+            mock.stop()
+        self.assertEqual(300, len(ids))
+        self.assertEqual(sorted(expected), sorted(ids))
+        first = [str(auto_id) for (auto_id, year, body, fuel) in mock.cars if year <= 2012]
+        self.assertEqual(first, ids[:len(first)])
+
+    def temp_cache(self, **options):
+        # Shared config reading a fresh cache store until the test ends
+        location = tempfile.mkdtemp()
+        config, saved = self.temp_config(location, **options)
+        store, config.store = config.store, CacheStore(config)
+        config.sections = saved
+        self.addCleanup(shutil.rmtree, location)
+        self.addCleanup(setattr, config, 'store', store)
+        self.addCleanup(config.store.close)
+        return config.store
+
+    def catalog_search(self, mock):
+        search = Advertisement()
+        search.ria_dev_url = mock.start()
+        self.addCleanup(mock.stop)
+        return search
+
+    def test_search_pages(self):
+        mock = MockRia(45)
+        search = self.catalog_search(mock)
+        search.countpage = 20
+        parameters = dict(search.parameters, countpage=search.countpage)
+        jobs = search.page_jobs(parameters, 45)
+        self.assertEqual([(1, 20), (2, 5)], [(page, expected) for (p, page, expected) in jobs])
+        self.assertEqual([(1, 20)], [(page, expected) for (p, page, expected) in search.page_jobs(parameters, 40)])
+        # Second page misses a few ids, the rest are still searched
+        search_page = mock.search
+
+        def short_page(query):
+            result = search_page(query)
+            if query.get('page') == '1':
+                del result['result']['search_result']['ids'][-3:]
+            return result
+        mock.search = short_page
+        with self.assertLogs('ria.run', 'WARNING') as logs:
+            pages = search.search_pages(search.ria_dev_url + '/auto/search/', jobs)
+        expected = [str(car[0]) for car in mock.cars]
+        self.assertEqual([expected[20:37], expected[40:45]], pages)
+        self.assertIn('Got fewer ids than expected on pages 2', logs.output[0])
+
+    def test_stale_catalog(self):
+        old = [{'name': 'Ford', 'value': 24}]
+        store = self.temp_cache()
+        store.put('makes', '', old)
+        # Expired, but younger than catalog_max_age
+        store.default_ttl = 1e-9
+        mock = MockRia(10, latency=0.3)
+        search = self.catalog_search(mock)
+        start = time.time()
+        self.assertEqual(old, search.all('makes'))
+        self.assertEqual(old, search.all('makes'))
+        self.assertLess(time.time() - start, mock.latency)
+        # Both reads wait for the same background fetch
+        self.assertTrue(search.refresh(search.catalog_url('makes'), 'makes').result())
+        self.assertEqual(1, mock.requests)
+        self.assertEqual(mock.fixtures['marks'], store.get('makes', ''))
+
+    def test_outdated_catalog(self):
+        store = self.temp_cache()
+        store.put('makes', '', [{'name': 'Ford', 'value': 24}])
+        store.default_ttl = 1e-9
+        mock = MockRia(10)
+        search = self.catalog_search(mock)
+        search.catalog_max_age = 1e-9
+        self.assertEqual(mock.fixtures['marks'], search.all('makes'))
+        self.assertEqual(1, mock.requests)
+
+    def test_failed_catalog_refresh(self):
+        old = [{'name': 'Ford', 'value': 24}]
+        store = self.temp_cache()
+        store.put('makes', '', old)
+        store.default_ttl = 1e-9
+        search = self.catalog_search(MockRia(10, error_rate=1.0))
+        self.assertEqual(old, search.all('makes'))
+        self.assertFalse(search.refresh(search.catalog_url('makes'), 'makes').result())
+        self.assertEqual(old, store.get('makes', ''))
+
+    def test_warm_cache(self):
+        store = self.temp_cache()
+        mock = MockRia(10)
+        search = self.catalog_search(mock)
+        search.make_id = 24
+        # Seven catalogs and the models of the make
+        self.assertEqual(8, search.warm_cache())
+        self.assertEqual(8, mock.requests)
+        self.assertEqual(mock.fixtures['models'], store.get('models', 24))
+        mock.error_rate = 1.0
+        self.assertEqual(0, search.warm_cache())
+
+    run_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')
+
+    def mock_workdir(self, mock):
+        # Fresh folder with its own config and key, searching the mock API
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        subprocess.run([sys.executable, self.run_py], cwd=workdir, input=b'test\n', stdout=subprocess.DEVNULL,
+                       check=True)
+        config = configparser.ConfigParser()
+        config.read(os.path.join(workdir, 'config', 'ria.ini'))
+        config['RIA_CONFIG']['api_url'] = mock.start()
+        self.addCleanup(mock.stop)
+        with open(os.path.join(workdir, 'config', 'ria.ini'), 'w') as f:
+            config.write(f)
+        return workdir
+
+    def run_mock(self, workdir, *args):
+        return subprocess.run([sys.executable, self.run_py] + list(args), cwd=workdir, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
 
-    def test_get_all_models(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-get', 'all-models', '-m', 'Ford', '-v'])
-        self.assertTrue(actual)
+    def test_mock_search(self):
+        workdir = self.mock_workdir(MockRia(150))
+        actual = self.run_mock(workdir, '-m', 'Ford', '-M', 'Focus', '-qm', '--metrics', 'metrics.json')
+        self.assertEqual(0, actual.returncode)
+        with open(os.path.join(workdir, 'metrics.json')) as f:
+            self.assertEqual(150, json.load(f)['requests']['info']['count'])
+        self.assertEqual(['FordFocus_150'], [name[:13] for name in os.listdir(os.path.join(workdir, 'results'))])
 
-    def test_get_all_bodies(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-get', 'all-bodies', '-v'])
-        self.assertTrue(actual)
+    def test_mock_average_price(self):
+        workdir = self.mock_workdir(MockRia(10))
+        actual = self.run_mock(workdir, '-get', 'average-price', '-m', 'Ford', '-M', 'Focus', '-v')
+        self.assertEqual(0, actual.returncode)
+        self.assertIn(b'Arithmetic mean', actual.stdout)
 
     def test_invalid_make(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-m', 'Abc', '-v'])
-        self.assertTrue(actual)
+        actual = self.run_mock(self.mock_workdir(MockRia(10)), '-m', 'Abc', '-v')
+        self.assertEqual(2, actual.returncode)
+        self.assertIn(b"invalid choice: 'Abc'", actual.stderr)
 
     def test_invalid_model(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-m', 'Ford', '-M', 'Abc' '-v'])
-        self.assertTrue(actual)
+        actual = self.run_mock(self.mock_workdir(MockRia(10)), '-m', 'Ford', '-M', 'Abc', '-v')
+        self.assertEqual(2, actual.returncode)
+        self.assertIn(b"UNKNOWN MODEL 'Abc'", actual.stdout)
 
     def test_invalid_body(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-m', 'Ford', '--body', 'abc', '-v'])
-        self.assertTrue(actual)
+        actual = self.run_mock(self.mock_workdir(MockRia(10)), '-m', 'Ford', '--body', 'abc', '-v')
+        self.assertEqual(2, actual.returncode)
+        self.assertIn(b"invalid choice: 'abc'", actual.stderr)
 
     def test_invalid_gearbox(self):
-        actual = subprocess.check_output(['python3', 'run.py', '-m', 'Ford', '--gearbox', 'abc', '-v'])
-        self.assertTrue(actual)
+        actual = self.run_mock(self.mock_workdir(MockRia(10)), '-m', 'Ford', '--gearbox', 'abc', '-v')
+        self.assertEqual(2, actual.returncode)
+        self.assertIn(b"invalid choice: 'abc'", actual.stderr)
 
     def tearDown(self):
         for f in self.to_remove: